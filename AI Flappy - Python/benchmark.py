@@ -0,0 +1,279 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import neat
+import numpy as np
+import pygame
+
+import flappy
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.txt")
+
+# A fresh process (a spawned worker, a test run) should be able to import flappy within this
+STARTUP_TARGET_MS = 400
+
+
+def load_config(pop_size=None):
+    config = flappy.load_config(CONFIG_PATH)
+    if pop_size is not None:
+        config.pop_size = pop_size
+    return config
+
+
+# Compare NetworkBatch flap decisions with neat's per-network activate on random inputs
+def check_batch_parity(pop_size=200, samples=200, mutations=10, seed=1):
+    random.seed(seed)
+    config = load_config(pop_size)
+    genomes = list(neat.Population(config).population.values())
+    # Mutate so the networks grow hidden nodes and lose connections, like later generations
+    for g in genomes:
+        for _ in range(mutations):
+            g.mutate(config.genome_config)
+
+    networks = [neat.nn.FeedForwardNetwork.create(g, config) for g in genomes]
+    batch = flappy.NetworkBatch(genomes, config)
+    mismatches = 0
+    checked = 0
+    for sample in range(samples):
+        # Halfway through, keep a shuffled half of the networks, as Neural_Eval_Vector does when birds die
+        if sample == samples // 2:
+            rows = random.sample(range(len(networks)), len(networks) // 2)
+            batch.select(rows)
+            networks = [networks[i] for i in rows]
+        inputs = [(random.uniform(0, 730), random.uniform(0, 730), random.uniform(0, 730)) for _ in networks]
+        batched = batch.activate(np.array(inputs))[:, 0] > 0.5
+        for net, row, flap in zip(networks, inputs, batched):
+            if (net.activate(row)[0] > 0.5) != flap:
+                mismatches += 1
+        checked += len(networks)
+    print("NetworkBatch parity: %d mismatched flaps out of %d" % (mismatches, checked))
+    return mismatches
+
+
+# Evolve a fresh, seeded population and report how many generations it gets through per second
+def generations_per_second(headless, generations=5, seed=1):
+    random.seed(seed)
+    flappy.GEN = -1
+    flappy.HEADLESS = headless
+    flappy.RENDER_EVERY = 0
+
+    p = neat.Population(load_config())
+
+    start = time.perf_counter()
+    p.run(flappy.Neural_Eval, generations)
+    elapsed = time.perf_counter() - start
+
+    # p.run stops early once the fitness threshold is reached, and p.generation stays 0 if that happens
+    # in the first generation, so count the generations Neural_Eval actually evaluated
+    return (flappy.GEN + 1) / elapsed
+
+
+# Headless frames per second of one evaluator, counted by a Profiler over a few seeded generations
+def frames_per_second(evaluate, pop_size, generations=3, seed=1):
+    random.seed(seed)
+    flappy.GEN = -1
+    flappy.HEADLESS = True
+    flappy.RENDER_EVERY = 0
+    flappy.SEED = seed
+
+    profiler = flappy.Profiler(keep_frames=False)
+    p = neat.Population(load_config(pop_size))
+    p.add_reporter(profiler)
+    flappy.PROFILER = profiler
+    try:
+        p.run(evaluate, generations)
+    finally:
+        flappy.PROFILER = flappy.NullProfiler()
+
+    frames = sum(row["frames"] for row in profiler.generations)
+    seconds = sum(row["seconds"] for row in profiler.generations)
+    return frames, seconds
+
+
+def bench_frames(pop_sizes, generations=3):
+    results = []
+    for pop_size in pop_sizes:
+        for evaluate in (flappy.Neural_Eval, flappy.Neural_Eval_Vector):
+            frames, seconds = frames_per_second(evaluate, pop_size, generations)
+            results.append({"case": "%s pop_size=%d" % (evaluate.__name__, pop_size), "frames": frames,
+                            "seconds": seconds, "fps": frames / seconds})
+            print("%-18s pop_size %5d: %8d frames in %7.3f s, %9.1f frames/s" % (evaluate.__name__, pop_size, frames, seconds, frames / seconds))
+    return results
+
+
+# Pipe.collide as it was before the masks were cached and the broad phase was added
+def legacy_collide(pipe, bird):
+    bird_mask = pygame.mask.from_surface(bird.img)
+    top_mask = pygame.mask.from_surface(pygame.transform.flip(flappy.load_image("pipe"), False, True))
+    bottom_mask = pygame.mask.from_surface(flappy.load_image("pipe"))
+
+    top_offset = (pipe.x - bird.x, pipe.top - round(bird.y))
+    bottom_offset = (pipe.x - bird.x, pipe.bottom - round(bird.y))
+
+    return bool(bird_mask.overlap(bottom_mask, bottom_offset) or bird_mask.overlap(top_mask, top_offset))
+
+
+# Average time of one frame's collision checks while a pipe crosses the screen
+def collide_frame_time(collide, pop_size, seed=1):
+    rng = random.Random(seed)
+    birds = [flappy.Bird(230, rng.uniform(0, 700)) for _ in range(pop_size)]
+    pipe = flappy.Pipe(flappy.WIND_WIDTH)
+    frames = 0
+
+    start = time.perf_counter()
+    while pipe.x + pipe.WIDTH >= 0:
+        for bird in birds:
+            collide(pipe, bird)
+        pipe.move()
+        frames += 1
+    return (time.perf_counter() - start) / frames
+
+
+def bench_collide(pop_sizes):
+    results = []
+    for pop_size in pop_sizes:
+        before = collide_frame_time(legacy_collide, pop_size)
+        after = collide_frame_time(flappy.Pipe.collide, pop_size)
+        results.append({"case": "pop_size=%d" % pop_size, "legacy_ms": before * 1000, "ms": after * 1000})
+        print("pop_size %5d: %9.3f ms/frame -> %9.3f ms/frame (%.1fx)" % (pop_size, before * 1000, after * 1000, before / after))
+    return results
+
+
+# Generations per second of ParallelNeuralEval for each worker count from 1 to max_workers,
+# against the serial per-bird Neural_Eval on the same seeded population and courses
+def bench_parallel(max_workers, pop_size=1000, generations=3, seed=1):
+    random.seed(seed)
+    flappy.GEN = -1
+    flappy.SEED = seed
+    flappy.HEADLESS = True
+    flappy.RENDER_EVERY = 0
+    p = neat.Population(load_config(pop_size))
+    start = time.perf_counter()
+    p.run(flappy.Neural_Eval, generations)
+    # p.run stops early once the fitness threshold is reached, so count the generations evaluated
+    baseline = (flappy.GEN + 1) / (time.perf_counter() - start)
+    results = [{"case": "serial Neural_Eval", "gen_per_s": baseline}]
+    print("serial Neural_Eval: %8.3f gen/s" % baseline)
+
+    for workers in range(1, max_workers + 1):
+        random.seed(seed)
+        flappy.GEN = -1
+        flappy.SEED = seed
+        p = neat.Population(load_config(pop_size))
+        evaluator = flappy.ParallelNeuralEval(workers)
+        try:
+            start = time.perf_counter()
+            p.run(evaluator.evaluate, generations)
+            rate = (flappy.GEN + 1) / (time.perf_counter() - start)
+        finally:
+            evaluator.close()
+        results.append({"case": "workers=%d" % workers, "gen_per_s": rate})
+        print("%2d workers: %8.3f gen/s (%.2fx serial Neural_Eval)" % (workers, rate, rate / baseline))
+    return results
+
+
+# Time for a fresh interpreter, started outside this folder, to import flappy (best of runs)
+def import_time(runs=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = "import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); import flappy; print(time.perf_counter() - start)" % here
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(here), env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1"))
+        times.append(float(out.stdout.split()[-1]))
+    return min(times)
+
+
+# What a worker has loaded after evaluating a shard: headless workers should need no images or fonts
+def worker_assets(job):
+    flappy.eval_shard(job)
+    return len(flappy.IMAGES) + len(flappy.MASKS) + len(flappy.FONTS)
+
+
+def bench_startup(workers=2, runs=5, seed=1):
+    seconds = import_time(runs)
+    print("import flappy: %7.1f ms (target %d ms, %s)" % (seconds * 1000, STARTUP_TARGET_MS, "ok" if seconds * 1000 <= STARTUP_TARGET_MS else "SLOW"))
+
+    # A spawned pool re-imports everything in each worker, as on Windows and macOS
+    random.seed(seed)
+    config = load_config(10)
+    genomes = list(neat.Population(config).population.items())
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        loaded = pool.map(worker_assets, [(genomes, config, flappy.Course(seed))] * workers)
+    spawn = time.perf_counter() - start
+    print("spawn %d workers and evaluate: %7.1f ms, assets loaded by workers: %d" % (workers, spawn * 1000, sum(loaded)))
+    return [{"case": "import", "ms": seconds * 1000}, {"case": "spawn workers=%d" % workers, "ms": spawn * 1000, "assets_loaded": sum(loaded)}]
+
+
+def bench_headless(generations):
+    rendered = generations_per_second(False, generations)
+    headless = generations_per_second(True, generations)
+    print("rendered: %8.2f gen/s" % rendered)
+    print("headless: %8.2f gen/s (%.1fx)" % (headless, headless / rendered))
+    return [{"case": "rendered", "gen_per_s": rendered}, {"case": "headless", "gen_per_s": headless}]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Writes the results with the commit and machine they came from, so runs on different commits can be compared
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump({"commit": git_revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                   "machine": platform.machine(), "results": results}, f, indent=2)
+
+
+# Prints every metric next to the same metric in an earlier results file
+def compare_results(path, results):
+    with open(path) as f:
+        old = json.load(f)
+    print("compared with %s (commit %s):" % (path, old.get("commit")))
+    for bench, rows in results.items():
+        old_rows = {row["case"]: row for row in old["results"].get(bench, [])}
+        for row in rows:
+            old_row = old_rows.get(row["case"])
+            if old_row is None:
+                continue
+            for metric, value in row.items():
+                if metric != "case" and isinstance(value, float) and old_row.get(metric):
+                    print("  %-10s %-32s %-10s %12.4f -> %12.4f (%.2fx)" % (bench, row["case"], metric, old_row[metric], value, value / old_row[metric]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Flappy training loop.")
+    parser.add_argument("--generations", type=int, default=5)
+    parser.add_argument("--pop-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--json", metavar="PATH", help="save the results to a JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with an earlier JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    results["startup"] = bench_startup()
+    results["headless"] = bench_headless(args.generations)
+    results["frames"] = bench_frames(args.pop_sizes)
+    results["collide"] = bench_collide(args.pop_sizes)
+    mismatches = check_batch_parity()
+    results["parity"] = [{"case": "mismatches", "mismatches": mismatches}]
+    results["parallel"] = bench_parallel(args.max_workers)
+
+    if args.json:
+        save_results(args.json, results)
+    if args.compare:
+        compare_results(args.compare, results)
+    # The timings are only meaningful if the batched networks decide like neat's own
+    if mismatches:
+        sys.exit("NetworkBatch parity failed: %d mismatched flaps" % mismatches)
@@ -1,25 +1,80 @@
 import pygame
 import neat
+import numpy as np
+import argparse
 import time
 import os
 import random
-pygame.font.init()
+import pickle
+import csv
+import json
+import multiprocessing
 # Window has width 600 and height 800
 WIND_WIDTH = 550
 WIND_HEIGHT = 800
 
 GEN = -1
 
-# Importing images
-BIRD_IMG = [pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "b1.png"))), pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "b2.png"))), pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "b3.png")))]
-PIPE_IMG = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "pipe.png")))
-BASE_IMG = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "base.png")))
-BG_IMG = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs", "bg.png")))
-STAT_FONT = pygame.font.SysFont("comicsans", 50)
+# Training mode, set from run(). Headless generations skip the window, the clock cap and drawing
+HEADLESS = False
+# In headless mode, still watch every Nth generation (0 never renders)
+RENDER_EVERY = 0
+# Base seed for pipe courses; generation g plays course SEED + g (None draws a fresh seed)
+SEED = None
+# A perfect bird never dies, so unrendered generations stop once this score is reached
+MAX_SCORE = 100
+
+# Images live next to this file, so flappy can be imported and run from any directory
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "imgs")
+BIRD_FRAMES = ("b1", "b2", "b3")
+
+# Sprite sizes after scale2x. Physics and the collision broad phase only need these, so
+# headless workers never load an image; images, masks and the font load on first use
+BIRD_WIDTH, BIRD_HEIGHT = 68, 48
+PIPE_WIDTH, PIPE_HEIGHT = 104, 640
+BASE_WIDTH = 672
+
+# Loaded images keyed by name ("pipe_top" is the flipped pipe)
+IMAGES = {}
+
+def load_image(name):
+    if name not in IMAGES:
+        if name == "pipe_top":
+            IMAGES[name] = pygame.transform.flip(load_image("pipe"), False, True)
+        else:
+            IMAGES[name] = pygame.transform.scale2x(pygame.image.load(os.path.join(IMG_DIR, name + ".png")))
+    return IMAGES[name]
+
+# Sprites never change, so each collision mask is built once instead of every frame
+MASKS = {}
+
+def load_mask(name):
+    if name not in MASKS:
+        MASKS[name] = pygame.mask.from_surface(load_image(name))
+    return MASKS[name]
+
+# SysFont scans the system fonts, so it only happens once something is drawn
+FONTS = {}
+
+def stat_font():
+    if "stat" not in FONTS:
+        pygame.font.init()
+        FONTS["stat"] = pygame.font.SysFont("comicsans", 50)
+    return FONTS["stat"]
+
+# Rotated bird frames keyed by (frame, tilt). Tilts move in steps of ROT_SPEED, so this stays small
+ROTATIONS = {}
+
+def rotate_bird(frame, tilt):
+    key = (frame, tilt)
+    if key not in ROTATIONS:
+        ROTATIONS[key] = pygame.transform.rotate(load_image(BIRD_FRAMES[frame]), tilt)
+    return ROTATIONS[key]
 
 class Bird:
     # Bird behaviour constants
-    IMG = BIRD_IMG
+    WIDTH = BIRD_WIDTH
+    HEIGHT = BIRD_HEIGHT
     M_ROTATION = 5
     ROT_SPEED = 5
     ANIMATION_t = 2
@@ -32,7 +87,7 @@ class Bird:
         self.speed = 0
         self.height = self.y
         self.img_count = 0
-        self.img = self.IMG[0]
+        self.frame = 0
     
     # Bird flaps!
     def flap(self):
@@ -65,50 +120,189 @@ class Bird:
         self.img_count += 1
 
         if self.img_count < self.ANIMATION_t:
-            self.img = self.IMG[0]
+            self.frame = 0
         elif self.img_count < self.ANIMATION_t*2:
-            self.img = self.IMG[1]
+            self.frame = 1
         elif self.img_count < self.ANIMATION_t*3:
-            self.img = self.IMG[2]
+            self.frame = 2
         elif self.img_count < self.ANIMATION_t*4:
-            self.img = self.IMG[1]
+            self.frame = 1
         elif self.img_count == self.ANIMATION_t*4 + 1:
-            self.img = self.IMG[0]
+            self.frame = 0
             self.img_count = 0
 
         if self.tilt <= -80:
-            self.img = self.IMG[1]
+            self.frame = 1
             self.img_count = self.ANIMATION_t*2
 
         # Bird rotates around center. Got from stackoverflow but can't find the link :(
-        rotated_img = pygame.transform.rotate(self.img, self.tilt)
+        rotated_img = rotate_bird(self.frame, self.tilt)
         new_rect = rotated_img.get_rect(center = self.img.get_rect(topleft = (self.x, self.y)).center)
-        win.blit(rotated_img, new_rect.topleft)
-    
+        return win.blit(rotated_img, new_rect.topleft)
+
+    # Current animation frame, loaded on first use
+    @property
+    def img(self):
+        return load_image(BIRD_FRAMES[self.frame])
+
     def get_mask(self):
-        return pygame.mask.from_surface(self.img)
+        return load_mask(BIRD_FRAMES[self.frame])
+
+# The whole population as NumPy arrays (struct of arrays), so physics, boundary and
+# collision checks advance every bird in one batched step instead of a Python loop.
+# Uses the same constants as Bird; dead birds keep moving but are masked out by alive
+# until select() drops them.
+class Flock:
+    M_ROTATION = Bird.M_ROTATION
+    ROT_SPEED = Bird.ROT_SPEED
+
+    def __init__(self, size, x, y):
+        self.x = x
+        self.y = np.full(size, y, dtype=float)
+        self.tilt = np.zeros(size)
+        self.tick_count = np.zeros(size)
+        self.speed = np.zeros(size)
+        # Bird.flap sets self.hight, so a bird's height stays at its starting y
+        self.height = np.full(size, y, dtype=float)
+        self.alive = np.ones(size, dtype=bool)
+        self.width = BIRD_WIDTH
+        self.img_height = BIRD_HEIGHT
+
+    # Keep only the birds at rows, in that order
+    def select(self, rows):
+        self.y = self.y[rows]
+        self.tilt = self.tilt[rows]
+        self.tick_count = self.tick_count[rows]
+        self.speed = self.speed[rows]
+        self.height = self.height[rows]
+        self.alive = self.alive[rows]
+
+    # Flap every bird where mask is True
+    def flap(self, mask):
+        self.speed[mask] = -10.5
+        self.tick_count[mask] = 0
+
+    def move(self):
+        self.tick_count += 1
+        disp_x = self.speed * self.tick_count + 1.5*self.tick_count**2
+
+        # Making sure birds stay between bounds
+        disp_x = np.minimum(disp_x, 16)
+        disp_x = np.where(disp_x < 0, disp_x - 2, disp_x)
+
+        self.y += disp_x
+
+        rising = (disp_x < 0) | (self.y < self.height + 50)
+        falling_tilt = np.where(self.tilt > -90, self.tilt - self.ROT_SPEED, self.tilt)
+        self.tilt = np.where(rising, np.maximum(self.tilt, self.M_ROTATION), falling_tilt)
+
+    # Living birds that hit the pipe, judged by the gap rather than pixel masks
+    def collide(self, pipe):
+        if self.x + self.width <= pipe.x or self.x >= pipe.x + pipe.WIDTH:
+            return np.zeros_like(self.alive)
+        bird_y = np.round(self.y)
+        return self.alive & ((bird_y < pipe.height) | (bird_y + self.img_height > pipe.bottom))
+
+    # Living birds that flew over or under the map
+    def out_of_bounds(self):
+        return self.alive & ((self.y + self.img_height >= 730) | (self.y < 0))
+
+# Every feed-forward network of a generation compiled into padded NumPy matrices, so one
+# activate() call evaluates the whole population. Columns hold inputs, then outputs, then
+# hidden nodes; nodes are updated one depth at a time so their inputs are always final.
+# Mirrors neat's FeedForwardNetwork, which is why only tanh and sum nodes are supported.
+class NetworkBatch:
+    def __init__(self, genomes, config):
+        genome_config = config.genome_config
+        tanh = genome_config.activation_defs.get("tanh")
+        summed = genome_config.aggregation_function_defs.get("sum")
+        io_keys = genome_config.input_keys + genome_config.output_keys
+        self.n_inputs = len(genome_config.input_keys)
+        self.output_cols = list(range(self.n_inputs, len(io_keys)))
+
+        compiled = []
+        for g in genomes:
+            net = neat.nn.FeedForwardNetwork.create(g, config)
+            columns = {key: i for i, key in enumerate(io_keys)}
+            depth = {key: 0 for key in genome_config.input_keys}
+            nodes = []
+            for node, act, agg, bias, response, links in net.node_evals:
+                if act is not tanh or agg is not summed:
+                    raise ValueError("NetworkBatch only supports tanh activation with sum aggregation")
+                columns.setdefault(node, len(columns))
+                depth[node] = 1 + max((depth[i] for i, _ in links), default=0)
+                nodes.append((columns[node], depth[node], bias, response, [(columns[i], w) for i, w in links]))
+            compiled.append((len(columns), nodes))
+
+        size = max((n for n, _ in compiled), default=len(io_keys))
+        max_depth = max((d for _, nodes in compiled for _, d, _, _, _ in nodes), default=0)
+        weights = np.zeros((len(compiled), size, size))
+        bias = np.zeros((len(compiled), size))
+        response = np.zeros((len(compiled), size))
+        node_depth = np.zeros((len(compiled), size), dtype=int)
+        for g, (_, nodes) in enumerate(compiled):
+            for col, d, b, r, links in nodes:
+                node_depth[g, col] = d
+                bias[g, col] = b
+                response[g, col] = r
+                for i, w in links:
+                    weights[g, i, col] = w
+
+        # One entry per depth, cut down to the columns some network has a node in at that depth:
+        # (columns, which networks have a node there, weights into them, bias, response)
+        self.size = size
+        self.count = len(compiled)
+        self.layers = []
+        for d in range(1, max_depth + 1):
+            cols = np.flatnonzero((node_depth == d).any(axis=0))
+            self.layers.append((cols, node_depth[:, cols] == d, weights[:, :, cols], bias[:, cols], response[:, cols]))
+
+    # Keep only the networks at rows (e.g. those whose birds are still alive), in that order.
+    # Depths and columns none of them use are dropped, so survivors' simple networks stay cheap
+    def select(self, rows):
+        layers = []
+        for cols, mask, weights, bias, response in self.layers:
+            mask = mask[rows]
+            used = mask.any(axis=0)
+            if used.any():
+                layers.append((cols[used], mask[:, used], weights[rows][:, :, used], bias[rows][:, used], response[rows][:, used]))
+        self.layers = layers
+        self.count = len(rows)
+
+    # inputs has one row per network; returns one row of outputs per network
+    def activate(self, inputs):
+        values = np.zeros((self.count, self.size))
+        values[:, :self.n_inputs] = inputs
+        for cols, mask, weights, bias, response in self.layers:
+            s = np.matmul(values[:, None, :], weights)[:, 0]
+            # Same scaling as neat's tanh_activation. Its clamp to +-60 is left out: tanh is already
+            # exactly +-1 there, so it never changes the result
+            values[:, cols] = np.where(mask, np.tanh(2.5 * (bias + response * s)), values[:, cols])
+        return values[:, self.output_cols]
 
 class Pipe:
     # Pipe behaviour constants
     PGAP = 200
     SPD = 5
+    WIDTH = PIPE_WIDTH
+    HEIGHT = PIPE_HEIGHT
     # Initialize pipes!
-    def __init__(self, x):
+    def __init__(self, x, height=None):
         self.x = x
         self.height = 0
 
         self.top = 0
         self.bottom = 0
-        self.PIPE_TOP = pygame.transform.flip(PIPE_IMG, False, True)
-        self.PIPE_BOTTOM = PIPE_IMG
 
         self.passed = False
-        self.set_height()
+        self.set_height(height)
 
     # Position of the pipes in the window
-    def set_height(self):
-        self.height = random.randrange(50, 450)
-        self.top = self.height - self.PIPE_TOP.get_height()
+    def set_height(self, height=None):
+        if height is None:
+            height = random.randrange(50, 450)
+        self.height = height
+        self.top = self.height - self.HEIGHT
         self.bottom = self.height + self.PGAP
 
     # Pipe moves toward the left
@@ -117,29 +311,52 @@ class Pipe:
 
     # Show the pipe!
     def draw(self, win):
-        win.blit(self.PIPE_TOP, (self.x, self.top))
-        win.blit(self.PIPE_BOTTOM, (self.x, self.bottom))
+        return [win.blit(load_image("pipe_top"), (self.x, self.top)), win.blit(load_image("pipe"), (self.x, self.bottom))]
 
     # Check if bird hits pipe
     def collide(self, bird):
-        bird_mask = bird.get_mask()
-        top_mask = pygame.mask.from_surface(self.PIPE_TOP)
-        bottom_mask = pygame.mask.from_surface(self.PIPE_BOTTOM)
+        bird_y = round(bird.y)
 
-        top_offset = (self.x - bird.x, self.top - round(bird.y))
-        bottom_offset = (self.x - bird.x, self.bottom - round(bird.y))
+        # Broad phase: birds outside the pipe's columns, or fully inside the gap, can't touch it
+        if bird.x + bird.WIDTH <= self.x or bird.x >= self.x + self.WIDTH:
+            return False
+        if bird_y >= self.height and bird_y + bird.HEIGHT <= self.bottom:
+            return False
 
-        b_point = bird_mask.overlap(bottom_mask, bottom_offset)
-        t_point = bird_mask.overlap(top_mask, top_offset)
+        bird_mask = bird.get_mask()
+        top_offset = (self.x - bird.x, self.top - bird_y)
+        bottom_offset = (self.x - bird.x, self.bottom - bird_y)
+
+        b_point = bird_mask.overlap(load_mask("pipe"), bottom_offset)
+        t_point = bird_mask.overlap(load_mask("pipe_top"), top_offset)
 
         if t_point or b_point:
             return True
         return False
 
+# Seeded, reproducible pipe heights. Heights are streamed lazily from the seed and kept, so one
+# Course (or just its seed) can be shared by workers, re-evaluations and replays
+class Course:
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.heights = []
+
+    # Height of the index-th pipe of the course
+    def height(self, index):
+        while len(self.heights) <= index:
+            self.heights.append(self.rng.randrange(50, 450))
+        return self.heights[index]
+
+# The course the current generation plays
+def generation_course():
+    return Course(None if SEED is None else SEED + GEN)
+
 class Base:
     SPD = 5
-    WIDTH = BASE_IMG.get_width()
-    IMG = BASE_IMG
+    WIDTH = BASE_WIDTH
 
     def __init__(self, y):
         self.y = y
@@ -157,26 +374,129 @@ class Base:
             self.x2 = self.x1 +self.WIDTH
 
     def draw(self, win):
-        win.blit(self.IMG, (self.x1, self.y))
-        win.blit(self.IMG, (self.x2, self.y))
+        img = load_image("base")
+        return [win.blit(img, (self.x1, self.y)), win.blit(img, (self.x2, self.y))]
+
+# Actually draw bird, pipes, and base in the window. Only the background is static, so each frame
+# paints it back over last frame's sprites and pushes just those rects plus this frame's to the display
+class Renderer:
+    def __init__(self, win):
+        self.win = win
+        self.dirty = None
+        self.labels = {}
+
+    # Text only gets re-rendered when its value changes
+    def label(self, name, value):
+        cached = self.labels.get(name)
+        if cached is None or cached[0] != value:
+            cached = (value, stat_font().render(name + ": " + str(value), 1, (255,255,255)))
+            self.labels[name] = cached
+        return cached[1]
+
+    def draw(self, birds, pipes, base, score, gen):
+        win = self.win
+        bg = load_image("bg")
+        if self.dirty is None:
+            win.blit(bg, (0, 0))
+        else:
+            for rect in self.dirty:
+                win.blit(bg, rect, rect)
 
-# Actually draw bird, pipes, and base in the window
-def draw_window(win, birds, pipes, base, score, gen):
-    win.blit(BG_IMG, (0, 0))
+        drawn = []
+        for pipe in pipes:
+            drawn += pipe.draw(win)
+        drawn += base.draw(win)
 
-    for pipe in pipes:
-        pipe.draw(win)
+        for bird in birds:
+            drawn.append(bird.draw(win))
 
-        text = STAT_FONT.render("Score: " + str(score), 1, (255,255,255))
-        win.blit(text, (WIND_WIDTH - 10 - text.get_width(), 10))
+        text = self.label("Score", score)
+        drawn.append(win.blit(text, (WIND_WIDTH - 10 - text.get_width(), 10)))
+        text = self.label("Gen", gen)
+        drawn.append(win.blit(text, (10, 10)))
 
-        text = STAT_FONT.render("Gen: " + str(gen), 1, (255,255,255))
-        win.blit(text, (10, 10))
-    base.draw(win)
+        if self.dirty is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.dirty + drawn)
+        self.dirty = drawn
+
+# Stands in for Profiler when profiling is off, so the hot loop can always call it
+class NullProfiler:
+    def start_frame(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def end_frame(self, alive):
+        pass
+
+# Opt-in timing of the training loop. The eval functions call lap() after each phase of a frame;
+# as a neat reporter it also times reproduction and rolls frames up into one row per generation
+class Profiler(neat.reporting.BaseReporter):
+    PHASES = ("physics", "activate", "collision", "pipes", "render")
+
+    def __init__(self, keep_frames=True):
+        self.keep_frames = keep_frames
+        self.frames = []
+        self.generations = []
+        self.generation = None
+        self.current = None
+
+    def start_generation(self, generation):
+        self.generation = {"generation": generation, "frames": 0, "bird_frames": 0, "seconds": 0.0, "fps": 0.0,
+                           "reproduction": 0.0}
+        self.generation.update(dict.fromkeys(self.PHASES, 0.0))
+        self.started = time.perf_counter()
+
+    def post_evaluate(self, config, population, species, best_genome):
+        row = self.generation
+        row["seconds"] = time.perf_counter() - self.started
+        if row["seconds"] > 0:
+            row["fps"] = row["frames"] / row["seconds"]
+        self.generations.append(row)
+        self.evaluated = time.perf_counter()
+
+    def end_generation(self, config, population, species_set):
+        self.generations[-1]["reproduction"] = time.perf_counter() - self.evaluated
+
+    def start_frame(self):
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self, alive):
+        row = self.generation
+        if row is None:
+            # Called outside p.run (e.g. replay), so there is no generation to roll into
+            return
+        row["frames"] += 1
+        row["bird_frames"] += int(alive)
+        for phase, seconds in self.current.items():
+            row[phase] += seconds
+        if self.keep_frames:
+            frame = {"generation": row["generation"], "frame": row["frames"], "alive": int(alive)}
+            frame.update(self.current)
+            self.frames.append(frame)
+
+    # Writes per-generation rows, or per-frame rows with frames=True, as .json or .csv
+    def dump(self, path, frames=False):
+        rows = self.frames if frames else self.generations
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(rows, f, indent=2)
+        else:
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+                writer.writeheader()
+                writer.writerows(rows)
 
-    for bird in birds:
-        bird.draw(win)
-    pygame.display.update()
+PROFILER = NullProfiler()
 
 def Neural_Eval(genomes, config):
     global GEN
@@ -193,25 +513,34 @@ def Neural_Eval(genomes, config):
         g.fitness = 0
         genome.append(g)
 
+    course = generation_course()
     base = Base(730)
-    pipes = [Pipe(550)]
-    win = pygame.display.set_mode((WIND_WIDTH, WIND_HEIGHT))
-    clock = pygame.time.Clock()
+    pipes = [Pipe(550, course.height(0))]
+    spawned = 1
+
+    # Only open a window (and cap the frame rate) for generations we actually watch
+    render = not HEADLESS or (RENDER_EVERY > 0 and GEN % RENDER_EVERY == 0)
+    if render:
+        renderer = Renderer(pygame.display.set_mode((WIND_WIDTH, WIND_HEIGHT)))
+        clock = pygame.time.Clock()
+    elif pygame.display.get_surface() is not None:
+        pygame.display.quit()
 
     score = 0
     run = True
     while run:
-        clock.tick(35)
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False 
-                pygame.quit()
-                quit()
-
-
+        if render:
+            clock.tick(35)
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    run = False 
+                    pygame.quit()
+                    quit()
+
+        PROFILER.start_frame()
         pipe_ind = 0
         if len(birds) > 0:
-            if len(pipes) > 1 and birds[0].x > pipes[0].x + pipes[0].PIPE_TOP.get_width():
+            if len(pipes) > 1 and birds[0].x > pipes[0].x + pipes[0].WIDTH:
                 pipe_ind = 1
         else:
             run = False
@@ -221,11 +550,15 @@ def Neural_Eval(genomes, config):
         for x, bird in enumerate(birds):
             bird.move()
             genome[x].fitness += 0.1
+        PROFILER.lap("physics")
 
+        # Each bird decides from its own new position, so all of them can move before any decides
+        for x, bird in enumerate(birds):
             output = networks[x].activate((bird.y, abs(bird.y - pipes[pipe_ind].height), abs(bird.y - pipes[pipe_ind].bottom)))
 
             if output[0] > 0.5:
                 bird.flap()
+        PROFILER.lap("activate")
 
         add_pipe = False
         removed_pipes = []
@@ -242,42 +575,332 @@ def Neural_Eval(genomes, config):
                     pipe.passed = True
                     add_pipe = True
 
-            if pipe.x + pipe.PIPE_TOP.get_width() < 0:
+            if pipe.x + pipe.WIDTH < 0:
                 removed_pipes.append(pipe)
 
             pipe.move()
+        PROFILER.lap("collision")
 
         if add_pipe:
             score += 1
             # Reward birds that mke it through pipe
             for g in genome:
                 g.fitness += 5
-            pipes.append(Pipe(550))
+            pipes.append(Pipe(550, course.height(spawned)))
+            spawned += 1
         for r in removed_pipes:
             pipes.remove(r)
+        PROFILER.lap("pipes")
 
         # Punish birds that try to cheat the system by flying over or under the map
         for x, bird in enumerate(birds):
-            if bird.y + bird.img.get_height() >= 730 or bird.y < 0:
+            if bird.y + bird.HEIGHT >= 730 or bird.y < 0:
                 birds.pop(x)
                 networks.pop(x)
                 genome.pop(x)
+        PROFILER.lap("collision")
 
         base.move()
-        draw_window(win, birds, pipes, base, score, GEN)
+        PROFILER.lap("physics")
+        if render:
+            renderer.draw(birds, pipes, base, score, GEN)
+            PROFILER.lap("render")
+        PROFILER.end_frame(len(birds))
+
+        if not render and score >= MAX_SCORE:
+            break
+
+
+# Headless Neural_Eval on a Flock, for populations too large to loop over bird by bird
+def Neural_Eval_Vector(genomes, config, course=None):
+    global GEN
+    GEN += 1
+    if course is None:
+        course = generation_course()
+    genome = [g for _, g in genomes]
+    networks = NetworkBatch(genome, config)
+    flock = Flock(len(genome), 230, 350)
+    fitness = np.zeros(len(genome))
+    # index[i] is the genome of the flock's i-th bird. Whenever half the birds have died they are
+    # dropped from the flock and the networks, so late frames only pay for the survivors
+    index = np.arange(len(genome))
+    # Birds flown by fly_survivors once the flock gets too small to be worth batching
+    tail = None
+
+    pipes = [Pipe(550, course.height(0))]
+    spawned = 1
+    score = 0
+    while True:
+        alive = np.flatnonzero(flock.alive)
+        if len(alive) <= SCALAR_TAIL:
+            tail = [(flock_bird(flock, row), genome[index[row]], index[row]) for row in alive]
+            break
+        if 2 * len(alive) <= len(index):
+            flock.select(alive)
+            networks.select(alive)
+            index = index[alive]
+            alive = np.arange(len(index))
+
+        pipe_ind = 0
+        if len(pipes) > 1 and flock.x > pipes[0].x + pipes[0].WIDTH:
+            pipe_ind = 1
+
+        PROFILER.start_frame()
+        # Reward birds for going forward
+        flock.move()
+        fitness[index[alive]] += 0.1
+        PROFILER.lap("physics")
+
+        pipe = pipes[pipe_ind]
+        inputs = np.stack((flock.y, np.abs(flock.y - pipe.height), np.abs(flock.y - pipe.bottom)), axis=1)
+        output = networks.activate(inputs)
+        flock.flap(flock.alive & (output[:, 0] > 0.5))
+        PROFILER.lap("activate")
+
+        add_pipe = False
+        removed_pipes = []
+        for pipe in pipes:
+            # Punish birds that hit the pipe
+            hit = flock.collide(pipe)
+            fitness[index[hit]] -= 1
+            flock.alive &= ~hit
 
+            if not pipe.passed and pipe.x < flock.x:
+                pipe.passed = True
+                add_pipe = True
 
-def run(config_path):
-    config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet, neat.DefaultStagnation,config_path)
+            if pipe.x + pipe.WIDTH < 0:
+                removed_pipes.append(pipe)
+
+            pipe.move()
+        PROFILER.lap("collision")
+
+        if add_pipe:
+            score += 1
+            # Reward birds that make it through pipe
+            fitness[index[flock.alive]] += 5
+            pipes.append(Pipe(550, course.height(spawned)))
+            spawned += 1
+        for r in removed_pipes:
+            pipes.remove(r)
+        PROFILER.lap("pipes")
 
-    p = neat.Population(config)
+        # Birds that fly over or under the map are out
+        flock.alive &= ~flock.out_of_bounds()
+        PROFILER.lap("collision")
+        PROFILER.end_frame(np.count_nonzero(flock.alive))
+
+        if score >= MAX_SCORE:
+            break
+
+    if tail:
+        fly_survivors(tail, config, fitness, pipes, course, spawned, score)
+    for g, f in zip(genome, fitness):
+        g.fitness = float(f)
+
+
+# Below this many survivors, NumPy's fixed cost per call outweighs batching, and stepping
+# each bird in Python (as Neural_Eval does) is faster
+SCALAR_TAIL = 16
+
+# A Bird in the same state as the flock's bird at row
+def flock_bird(flock, row):
+    bird = Bird(flock.x, float(flock.y[row]))
+    bird.tilt = float(flock.tilt[row])
+    bird.tick_count = float(flock.tick_count[row])
+    bird.speed = float(flock.speed[row])
+    bird.height = float(flock.height[row])
+    return bird
+
+# Finishes a Neural_Eval_Vector episode for its last few birds, one bird at a time. Follows the
+# same rules as the batched loop (gap collisions, rewards in the same order), so fitness
+# doesn't depend on when the hand-over happens. tail holds (bird, genome, fitness row) triples
+def fly_survivors(tail, config, fitness, pipes, course, spawned, score):
+    birds = [bird for bird, _, _ in tail]
+    networks = [neat.nn.FeedForwardNetwork.create(g, config) for _, g, _ in tail]
+    rows = [row for _, _, row in tail]
+    x = birds[0].x
+
+    while birds and score < MAX_SCORE:
+        pipe_ind = 0
+        if len(pipes) > 1 and x > pipes[0].x + pipes[0].WIDTH:
+            pipe_ind = 1
+
+        PROFILER.start_frame()
+        for bird, row in zip(birds, rows):
+            bird.move()
+            fitness[row] += 0.1
+        PROFILER.lap("physics")
+
+        pipe = pipes[pipe_ind]
+        for bird, net in zip(birds, networks):
+            if net.activate((bird.y, abs(bird.y - pipe.height), abs(bird.y - pipe.bottom)))[0] > 0.5:
+                bird.flap()
+        PROFILER.lap("activate")
+
+        add_pipe = False
+        removed_pipes = []
+        for pipe in pipes:
+            # Punish birds that hit the pipe, judged by the gap like Flock.collide
+            if x + BIRD_WIDTH > pipe.x and x < pipe.x + pipe.WIDTH:
+                for i in reversed(range(len(birds))):
+                    bird_y = round(birds[i].y)
+                    if bird_y < pipe.height or bird_y + BIRD_HEIGHT > pipe.bottom:
+                        fitness[rows[i]] -= 1
+                        del birds[i], networks[i], rows[i]
+
+            if not pipe.passed and pipe.x < x:
+                pipe.passed = True
+                add_pipe = True
+
+            if pipe.x + pipe.WIDTH < 0:
+                removed_pipes.append(pipe)
+
+            pipe.move()
+        PROFILER.lap("collision")
+
+        if add_pipe:
+            score += 1
+            # Reward birds that make it through pipe
+            for row in rows:
+                fitness[row] += 5
+            pipes.append(Pipe(550, course.height(spawned)))
+            spawned += 1
+        for r in removed_pipes:
+            pipes.remove(r)
+        PROFILER.lap("pipes")
+
+        # Birds that fly over or under the map are out
+        for i in reversed(range(len(birds))):
+            if birds[i].y + BIRD_HEIGHT >= 730 or birds[i].y < 0:
+                del birds[i], networks[i], rows[i]
+        PROFILER.lap("collision")
+        PROFILER.end_frame(len(birds))
+
+
+# Runs in a worker process: one headless episode for a shard of genomes. Every shard of a
+# generation gets the same Course, so fitness stays comparable
+def eval_shard(job):
+    genomes, config, course = job
+    Neural_Eval_Vector(genomes, config, course)
+    return [g.fitness for _, g in genomes]
+
+# Splits each generation across a process pool, in the style of neat's ParallelEvaluator
+class ParallelNeuralEval:
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.pool = multiprocessing.Pool(num_workers)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def evaluate(self, genomes, config):
+        global GEN
+        GEN += 1
+        shards = [genomes[i::self.num_workers] for i in range(self.num_workers)]
+        shards = [shard for shard in shards if shard]
+        course = generation_course()
+        jobs = [(shard, config, course) for shard in shards]
+
+        for shard, fitnesses in zip(shards, self.pool.map(eval_shard, jobs)):
+            for (_, g), fitness in zip(shard, fitnesses):
+                g.fitness = fitness
+
+
+def load_config(config_path):
+    return neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction, neat.DefaultSpeciesSet, neat.DefaultStagnation,config_path)
+
+# Keep the best genome so it can be replayed without re-running evolution
+def save_winner(winner, winner_path):
+    with open(winner_path, "wb") as f:
+        pickle.dump(winner, f)
+
+def load_winner(winner_path):
+    with open(winner_path, "rb") as f:
+        return pickle.load(f)
+
+# Watch a saved winner play, inference only
+def replay(config_path, winner_path, seed=None):
+    global HEADLESS, SEED
+    HEADLESS = False
+    SEED = seed
+    winner = load_winner(winner_path)
+    Neural_Eval([(winner.key, winner)], load_config(config_path))
+
+
+def run(config_path, headless=False, render_every=0, generations=50, vectorized=False, workers=1, seed=None,
+        checkpoint_every=5, checkpoint_prefix="neat-checkpoint-", resume=None, winner_path="winner.pkl", profile_path=None,
+        profile_frames_path=None):
+    global HEADLESS, RENDER_EVERY, SEED, GEN, PROFILER
+    HEADLESS = headless
+    RENDER_EVERY = render_every
+    SEED = seed
+
+    if resume:
+        # Carries on from the checkpointed population, species and generation count
+        p = neat.Checkpointer.restore_checkpoint(resume)
+        GEN = p.generation - 1
+    else:
+        p = neat.Population(load_config(config_path))
 
     p.add_reporter(neat.StdOutReporter(True))
     stats = neat.StatisticsReporter()
     p.add_reporter(stats)
+    if checkpoint_every > 0:
+        p.add_reporter(neat.Checkpointer(checkpoint_every, None, checkpoint_prefix))
+    if profile_path or profile_frames_path:
+        # Per-frame rows are only kept when they will be written, since there can be thousands per generation
+        PROFILER = Profiler(keep_frames=bool(profile_frames_path))
+        p.add_reporter(PROFILER)
+
+    evaluator = None
+    if workers > 1:
+        evaluator = ParallelNeuralEval(workers)
+        eval_function = evaluator.evaluate
+    elif vectorized:
+        eval_function = Neural_Eval_Vector
+    else:
+        eval_function = Neural_Eval
+
+    try:
+        winner = p.run(eval_function, generations)
+    finally:
+        if evaluator is not None:
+            evaluator.close()
+        if profile_path:
+            PROFILER.dump(profile_path)
+        if profile_frames_path:
+            PROFILER.dump(profile_frames_path, frames=True)
+        PROFILER = NullProfiler()
+
+    if winner_path:
+        save_winner(winner, winner_path)
+    return winner
 
-    winner = p.run(Neural_Eval, 50)
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a NEAT population to play Flappy Bird.")
+    parser.add_argument("--headless", action="store_true", help="simulate without a window or frame cap")
+    parser.add_argument("--render-every", type=int, default=0, metavar="N", help="in headless mode, watch every Nth generation")
+    parser.add_argument("--vectorized", action="store_true", help="simulate the population as NumPy arrays (always headless)")
+    parser.add_argument("--workers", type=int, default=1, help="evaluate across this many processes (vectorized and headless)")
+    parser.add_argument("--seed", type=int, default=None, help="make pipe courses reproducible (generation g plays seed + g)")
+    parser.add_argument("--generations", type=int, default=50)
+    parser.add_argument("--checkpoint-every", type=int, default=5, metavar="N", help="save the population every N generations (0 disables)")
+    parser.add_argument("--checkpoint-prefix", default="neat-checkpoint-")
+    parser.add_argument("--resume", metavar="CHECKPOINT", help="continue evolution from a checkpoint file")
+    parser.add_argument("--winner", default="winner.pkl", help="where to save the best genome")
+    parser.add_argument("--replay", metavar="WINNER", help="watch a saved winner instead of training")
+    parser.add_argument("--profile", metavar="PATH", help="time each phase of the loop and write per-generation rows to PATH (.csv or .json)")
+    parser.add_argument("--profile-frames", metavar="PATH", help="time each phase of the loop and write per-frame rows to PATH (.csv or .json)")
+    args = parser.parse_args()
+
     local_dir = os.path.dirname(__file__)
     config_path = os.path.join(local_dir, "config.txt")
-    run(config_path)
\ No newline at end of file
+    if args.replay:
+        replay(config_path, args.replay, args.seed)
+    else:
+        run(config_path, headless=args.headless, render_every=args.render_every, generations=args.generations,
+            vectorized=args.vectorized, workers=args.workers, seed=args.seed, checkpoint_every=args.checkpoint_every,
+            checkpoint_prefix=args.checkpoint_prefix, resume=args.resume, winner_path=args.winner,
+            profile_path=args.profile, profile_frames_path=args.profile_frames)
@@ -0,0 +1,7 @@
+import benchmark
+
+
+# NetworkBatch has to flap exactly when neat's per-network activate does, before and after select()
+def test_batch_parity():
+    assert benchmark.check_batch_parity() == 0
+
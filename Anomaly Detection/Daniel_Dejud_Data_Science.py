@@ -2,43 +2,313 @@
 Daniel Dejud
 All work is original.
 """
+import numpy
 import pandas
-import openpyxl
 import os
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import cross_val_score, KFold
+import shutil
+import hashlib
+import argparse
+import glob
+import re
+import time
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+# scikit-learn and openpyxl are imported where they are used: importing scikit-learn alone takes
+# about a second, which every batch worker would otherwise pay even though only the reference
+# path needs it, and openpyxl is only needed for Excel sheets.
+# Parsing Excel files is slow, so parsed sheets are cached as binary arrays next to them.
+def sheetCacheKey(filename):
+    """
+    The sheetCacheKey() function identifies one version of a file for the parsed-sheet cache,
+    by hashing its absolute path, then its modification time and its contents.
+
+    Arguments:
+        filename (string): The file to identify.
+
+    Returns:
+        key (string): Two hexadecimal digests joined by "-": the first is the same for every
+                      version of the file, the second changes whenever the file does.
+    """
+    digest = hashlib.sha1()
+    digest.update(str(os.stat(filename).st_mtime_ns).encode())
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return hashlib.sha1(os.path.abspath(filename).encode()).hexdigest() + "-" + digest.hexdigest()
+
+
+def readExcelCached(filename, cacheDir=None):
+    """
+    The readExcelCached() function reads an Excel sheet, reusing an earlier parse when the file
+    has not changed. Numeric sheets whose columns share one type are cached as .npy arrays and
+    loaded back memory-mapped; any other sheet is cached as a pickled DataFrame. Only the
+    latest version of each file is kept: caching a new version removes the older ones. Entries
+    of files that were moved or deleted stay until the cache folder is deleted by hand.
+
+    Arguments:
+        filename (string): The Excel file to read.
+        cacheDir (string): The folder for cached sheets. Default is a ".sheetcache" folder next
+                           to the Excel file.
+
+    Returns:
+        sheet (DataFrame): The sheet's values, with no header row.
+    """
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(os.path.abspath(filename)), ".sheetcache")
+    key = sheetCacheKey(filename)
+    arrayPath = os.path.join(cacheDir, key + ".npy")
+    framePath = os.path.join(cacheDir, key + ".pkl")
+
+    # Reuse an earlier parse of this exact file if there is one.
+    if os.path.exists(arrayPath):
+        return pandas.DataFrame(numpy.load(arrayPath, mmap_mode="r"), copy=False)
+    if os.path.exists(framePath):
+        return pandas.read_pickle(framePath)
+
+    sheet = pandas.read_excel(filename, header = None)
+
+    # Write to a temporary name first, so a concurrent reader never sees a half-written cache file.
+    os.makedirs(cacheDir, exist_ok=True)
+    temporaryPath = os.path.join(cacheDir, f"{key}.{os.getpid()}.tmp")
+    if sheet.dtypes.nunique() == 1 and pandas.api.types.is_numeric_dtype(sheet.dtypes.iloc[0]):
+        with open(temporaryPath, "wb") as file:
+            numpy.save(file, sheet.to_numpy())
+        os.replace(temporaryPath, arrayPath)
+    else:
+        sheet.to_pickle(temporaryPath)
+        os.replace(temporaryPath, framePath)
+
+    # Remove the entries of earlier versions of this file. One still memory-mapped by another
+    # process cannot be removed on Windows, and is left for the next new version to remove.
+    pathKey = key.split("-")[0]
+    for extension in (".npy", ".pkl"):
+        for stalePath in glob.glob(os.path.join(glob.escape(cacheDir), pathKey + "-*" + extension)):
+            if os.path.basename(stalePath) != key + extension:
+                try:
+                    os.remove(stalePath)
+                except OSError:
+                    pass
+    return sheet
+
+
+def readSheet(filename, cacheDir=None):
+    """
+    The readSheet() function reads a sheet of measurements from any of the supported formats,
+    chosen by file extension: Excel (.xlsx, .xls, cached by readExcelCached()), CSV (.csv),
+    Parquet (.parquet) or NumPy (.npy, memory-mapped). None of the formats has a header row.
+
+    Arguments:
+        filename (string): The file to read; it has format <filename>.<file extension>.
+        cacheDir (string): The folder for cached Excel sheets. Default is next to the file.
+
+    Returns:
+        sheet (DataFrame): The sheet's values, with columns numbered from 0.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        return pandas.read_csv(filename, header = None)
+    if extension == ".parquet":
+        sheet = pandas.read_parquet(filename)
+        sheet.columns = range(sheet.shape[1])
+        return sheet
+    if extension == ".npy":
+        return pandas.DataFrame(numpy.load(filename, mmap_mode="r"), copy=False)
+    return readExcelCached(filename, cacheDir)
+
+
+# Zero or missing controls are handled while dividing, so dirty sheets need no separate cleaning pass.
+def safeDivide(experimental, control, policy="skip"):
+    """
+    The safeDivide() function divides experimental values by control values in one vectorized
+    pass, only where the control is a usable number. Cells whose control is zero or missing are
+    handled according to policy:
+        "skip":   the ratio is NaN, so the cell is left out of the fit and never flagged.
+        "flag":   the ratio is infinite, so the cell is left out of the fit and always flagged.
+        "impute": the control is replaced by the median of the column's usable controls.
+    Cells with a missing experimental value always get a NaN ratio.
+
+    Arguments:
+        experimental (ndarray): The experimental values.
+        control (ndarray):      The control values, with the same shape.
+        policy (str):           "skip", "flag" or "impute". Default is "skip".
+
+    Returns:
+        ratio (ndarray): The ratio of every experimental value to its control value.
+        counts (dict):   How many controls were zero or missing, how many experimental values
+                         were missing, and how many cells the policy was applied to.
+    """
+    if policy not in ("skip", "flag", "impute"):
+        raise ValueError(f"Unknown policy for zero or missing controls: {policy}")
+    experimental = numpy.asarray(experimental, dtype=float)
+    control = numpy.asarray(control, dtype=float)
+    if experimental.shape != control.shape:
+        raise ValueError("The control and experimental sheets do not have the same shape.")
+
+    zeroControl = control == 0
+    missingControl = ~numpy.isfinite(control)
+    missingExperimental = numpy.isnan(experimental)
+    badControl = (zeroControl | missingControl) & ~missingExperimental
+
+    ratio = numpy.full(control.shape, numpy.nan)
+    numpy.divide(experimental, control, out=ratio, where=~badControl & ~missingExperimental)
+
+    if policy == "flag":
+        ratio[badControl] = numpy.inf
+    elif policy == "impute" and badControl.any():
+        usable = numpy.where(zeroControl | missingControl, numpy.nan, control)
+        medians = pandas.DataFrame(usable).median().to_numpy()
+        rows, columns = numpy.nonzero(badControl)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratio[rows, columns] = experimental[rows, columns] / medians[columns]
+
+    counts = {"zeroControls": int(zeroControl.sum()), "missingControls": int(missingControl.sum()),
+              "missingExperimental": int(missingExperimental.sum()), policy: int(badControl.sum())}
+    return ratio, counts
+
+
+def describeNormalization(filename, counts):
+    """
+    The describeNormalization() function prints what safeDivide() did to a sheet, if anything.
+
+    Arguments:
+        filename (string): The experimental file the counts belong to.
+        counts (dict):     The counts returned by safeDivide().
+    """
+    if any(counts.values()):
+        details = ", ".join(f"{value} {name}" for name, value in counts.items())
+        print(f"{os.path.basename(filename)}: {details}")
+
+
 # First, we need to normalize the experimental data with respect to the control data.
-def normalize(controlFilename, experimentalFilename):
+def normalize(controlFilename, experimentalFilename, cacheDir=None, policy="skip"):
     """
-    The normalize() function computes the ratio of every cell in the experimental Excel file with
-    every cell in the control Excel file. It does so by utilizing the "pandas" module to read in
-    the values from the Excel files into DataFrames and then calculating the ratio between them.
+    The normalize() function computes the ratio of every cell in the experimental file with
+    every cell in the control file. It does so by reading both sheets into DataFrames with
+    readSheet(), which accepts Excel, CSV, Parquet and NumPy files and caches parsed Excel
+    sheets, and then calculating the ratio between them.
 
     Arguments: 
-        controlFilename (string):       the filename for the Excel document where the control quantities are;
+        controlFilename (string):       the filename for the document where the control quantities are;
                                         it has format <filename>.<file extension>
-        experimentalFilename (string):  the filename for the Excel focument where the experimental quantities are;
+        experimentalFilename (string):  the filename for the document where the experimental quantities are;
                                         it has format <filename>.<file extension>
+        cacheDir (string):              the folder for cached Excel sheets. Default is next to each file.
+        policy (string):                how to treat zero or missing controls: "skip", "flag" or "impute"
+                                        (see safeDivide()). Default is "skip".
 
     Returns: 
         normalizedData (DataFrame): Dataframe containing the ratio between the experimental DataFrame and the 
-                                    control DataFrame.
+                                    control DataFrame. Its attrs["normalization"] holds the counts
+                                    returned by safeDivide().
         experimental (DataFrame):   DataFrame containing the experimental data.
     """
     # Read data from the provided control file.
-    control = pandas.read_excel(controlFilename, header = None)
+    control = readSheet(controlFilename, cacheDir)
 
     # Read data from the provided experimental file.
-    experimental = pandas.read_excel(experimentalFilename, header = None)
+    experimental = readSheet(experimentalFilename, cacheDir)
 
     # Normalize and send back the wanted normalized data.
-    normalizedData = experimental / control
+    ratio, counts = safeDivide(experimental.to_numpy(), control.to_numpy(), policy)
+    normalizedData = pandas.DataFrame(ratio, index=experimental.index, columns=experimental.columns)
+    normalizedData.attrs["normalization"] = counts
 
     return normalizedData, experimental
 
 
+# The cross-validated RMSE of a one-feature linear regression, computed in closed form.
+def kFoldRmse(x, y, nFolds=5, randomState=42):
+    """
+    The kFoldRmse() function computes the average RMSE of a one-feature linear regression over
+    the same folds as KFold(n_splits=nFolds, shuffle=True, random_state=randomState). Instead of
+    fitting a model per fold, it sums x, y, x*x and x*y per fold in one pass, derives each
+    training set's least-squares line from the totals minus that fold, and scores the fold.
+
+    Arguments:
+        x (ndarray):      The feature values (experimental data).
+        y (ndarray):      The target values (ratio of experimental to control data).
+        nFolds (int):     The number of folds. Default is 5.
+        randomState (int): The seed KFold shuffles with. Default is 42.
+
+    Returns:
+        avgRmse (float): The RMSE averaged over the folds, as cross_val_score would report it.
+    """
+    x = numpy.asarray(x, dtype=float).ravel()
+    y = numpy.asarray(y, dtype=float).ravel()
+    nSamples = len(x)
+    if nFolds < 2 or nFolds > nSamples:
+        raise ValueError(f"Cannot split {nSamples} samples into {nFolds} folds.")
+
+    # Assign every sample to its fold exactly the way a shuffled KFold does.
+    indices = numpy.arange(nSamples)
+    numpy.random.RandomState(randomState).shuffle(indices)
+    foldSizes = numpy.full(nFolds, nSamples // nFolds)
+    foldSizes[:nSamples % nFolds] += 1
+    fold = numpy.empty(nSamples, dtype=numpy.intp)
+    fold[indices] = numpy.repeat(numpy.arange(nFolds), foldSizes)
+
+    # Center on the overall means so the sums of squares keep their precision.
+    x = x - x.mean()
+    y = y - y.mean()
+
+    # Per-fold sufficient statistics; each training set is everything outside its fold.
+    count = numpy.bincount(fold, minlength=nFolds)
+    sums = [numpy.bincount(fold, weights=w, minlength=nFolds) for w in (x, y, x * x, x * y)]
+    trainN, trainX, trainY, trainXX, trainXY = [nSamples - count] + [total.sum() - total for total in sums]
+
+    # Least-squares line of each training set. A constant feature gets slope 0, as LinearRegression does.
+    meanX = trainX / trainN
+    meanY = trainY / trainN
+    varianceX = trainXX - trainN * meanX ** 2
+    covariance = trainXY - trainN * meanX * meanY
+    slope = numpy.divide(covariance, varianceX, out=numpy.zeros(nFolds), where=varianceX > 0)
+    intercept = meanY - slope * meanX
+
+    # Score every fold on its own samples with the line fitted without them.
+    residuals = y - (intercept[fold] + slope[fold] * x)
+    mse = numpy.bincount(fold, weights=residuals ** 2, minlength=nFolds) / count
+    return numpy.sqrt(mse).mean()
+
+
+# The original scikit-learn cross-validation, kept as the reference for kFoldRmse().
+def sklearnKFoldRmse(x, y, nFolds=5, randomState=42):
+    """
+    The sklearnKFoldRmse() function computes the same average RMSE as kFoldRmse() by fitting a
+    scikit-learn LinearRegression per fold with cross_val_score. It is much slower and is kept
+    to check the closed-form path against.
+
+    Arguments:
+        x (ndarray):      The feature values (experimental data).
+        y (ndarray):      The target values (ratio of experimental to control data).
+        nFolds (int):     The number of folds. Default is 5.
+        randomState (int): The seed KFold shuffles with. Default is 42.
+
+    Returns:
+        avgRmse (float): The RMSE averaged over the folds.
+    """
+    from sklearn.linear_model import LinearRegression
+    from sklearn.model_selection import cross_val_score, KFold
+
+    # Prepare the input features and target variable.
+    x = numpy.asarray(x).reshape(-1, 1)
+    y = numpy.asarray(y).reshape(-1, 1)
+
+    # Create a linear regression model.
+    model = LinearRegression()
+
+    # Create a KFold cross-validator object with the specified number of folds.
+    kfold = KFold(n_splits=nFolds, shuffle=True, random_state=randomState)
+
+    # Calculate the cross-validated RMSE scores.
+    rmseScores = cross_val_score(model, x, y, scoring='neg_root_mean_squared_error', cv=kfold)
+
+    # Calculate the average RMSE score.
+    return -1 * rmseScores.mean()
+
+
 # We determine an addequate threshold to analyze which values will be taken into account.
-def findThreshold(data, multiplier=1.0, nFolds=5):
+def findThreshold(data, multiplier=1.0, nFolds=5, method="closedForm"):
     """
     The findThreshold() function determines an adequate threshold based on the relationship between
     experimental data and the ratio of experimental to control data. It uses a linear regression
@@ -51,26 +321,27 @@ def findThreshold(data, multiplier=1.0, nFolds=5):
                             and 'Ratio' contains the corresponding ratio of experimental to control data.
         multiplier (float): A multiplier to adjust the calculated threshold value. Default is 1.0.
         nFolds (int):       The number of folds to use in cross-validation. Default is 5.
+        method (str):       "closedForm" computes the RMSE with kFoldRmse(); "sklearn" fits
+                            scikit-learn models with sklearnKFoldRmse(). Default is "closedForm".
 
     Returns:
         threshold (float): The calculated threshold value based on the RMSE and the given multiplier.
     """
     
-    # Prepare the input features and target variable.
-    x = data['Experimental'].values.reshape(-1, 1)
-    y = data['Ratio'].values.reshape(-1, 1)
-
-    # Create a linear regression model.
-    model = LinearRegression()
-
-    # Create a KFold cross-validator object with the specified number of folds.
-    kfold = KFold(n_splits=nFolds, shuffle=True, random_state=42)
-
-    # Calculate the cross-validated RMSE scores.
-    rmseScores = cross_val_score(model, x, y, scoring='neg_root_mean_squared_error', cv=kfold)
+    # Prepare the input features and target variable, leaving out cells that cannot be fitted
+    # (missing values, or ratios made NaN or infinite by safeDivide()).
+    x = data['Experimental'].to_numpy(dtype=float)
+    y = data['Ratio'].to_numpy(dtype=float)
+    finite = numpy.isfinite(x) & numpy.isfinite(y)
+    x, y = x[finite], y[finite]
 
-    # Calculate the average RMSE score.
-    avgRmse = -1 * rmseScores.mean()
+    # Calculate the cross-validated average RMSE score.
+    if method == "closedForm":
+        avgRmse = kFoldRmse(x, y, nFolds)
+    elif method == "sklearn":
+        avgRmse = sklearnKFoldRmse(x, y, nFolds)
+    else:
+        raise ValueError(f"Unknown threshold fitting method: {method}")
 
     # Calculate the threshold using the given multiplier and the average RMSE score.
     threshold = avgRmse * multiplier
@@ -78,6 +349,23 @@ def findThreshold(data, multiplier=1.0, nFolds=5):
     return threshold
 
 
+# Excel column letters are looked up from a table instead of being rebuilt for every cell.
+def columnLetters(nColumns):
+    """
+    The columnLetters() function builds the Excel column letters ("A", "B", ..., "AA", ...)
+    for the first nColumns columns of a sheet.
+
+    Arguments:
+        nColumns (int): The number of columns in the sheet.
+
+    Returns:
+        letters (list): A list where letters[column] is the letter of the zero-based column.
+    """
+    from openpyxl.utils import get_column_letter
+
+    return [get_column_letter(column + 1) for column in range(nColumns)]
+
+
 # We apply the threshold and filter the values, separating anomalies.
 def threshold(normalizedData, experimental, multiplier=1.0, nFolds = 5):
     """
@@ -96,8 +384,6 @@ def threshold(normalizedData, experimental, multiplier=1.0, nFolds = 5):
         withinthreshold (list): A list of tuples containing the accepted values and their
                                 original cell locations in the experimental data.
     """
-    
-    withinthreshold = []
 
     # Create a DataFrame containing experimental values and their corresponding ratios.
     data = pandas.DataFrame({"Experimental": experimental.values.flatten(), "Ratio": normalizedData.values.flatten()})
@@ -105,19 +391,74 @@ def threshold(normalizedData, experimental, multiplier=1.0, nFolds = 5):
     # Calculate the acceptable threshold using the findThreshold function.
     acceptableThreshold = findThreshold(data, multiplier, nFolds)
 
+    return findAnomalies(normalizedData, experimental, acceptableThreshold)
+
+
+# Flagging is separate from fitting so a sweep can flag many thresholds from one fit.
+def findAnomalyArrays(normalizedData, experimental, acceptableThreshold):
+    """
+    The findAnomalyArrays() function selects the values whose ratio lies at or beyond
+    acceptableThreshold from 1, in either direction, and returns them as typed arrays
+    instead of labelled tuples.
+
+    Arguments:
+        normalizedData (DataFrame):  A DataFrame containing the normalized data (ratio of
+                                     experimental to control data).
+        experimental (DataFrame):    A DataFrame containing the experimental data.
+        acceptableThreshold (float): How far from 1 a ratio may be before it is an anomaly.
+
+    Returns:
+        rows (ndarray):    The zero-based row of every anomaly, in row-major order.
+        columns (ndarray): The zero-based column of every anomaly.
+        values (ndarray):  The experimental value of every anomaly.
+    """
     # Set the lower and upper bounds based on the acceptable threshold.
     lowerBound = 1 - acceptableThreshold
     upperBound = 1 + acceptableThreshold
 
-    # Iterate through the normalized data and select values within the threshold bounds.
-    for row in range(normalizedData.shape[0]):
-        for column in range(normalizedData.shape[1]):
-            value = normalizedData.iloc[row, column]
-            saveValue = experimental.iloc[row, column]
-            # Filter and record the anomalies
-            if value <= lowerBound or value >= upperBound:
-                originalLocation = f"{openpyxl.utils.get_column_letter(column + 1)}{row + 1}"
-                withinthreshold.append((saveValue, originalLocation))
+    # Test every normalized value against the bounds at once. NaN ratios compare False, so they are never flagged.
+    ratios = normalizedData.to_numpy()
+    anomalies = (ratios <= lowerBound) | (ratios >= upperBound)
+
+    # Positions of the anomalies in row-major order, the same order as a cell-by-cell scan.
+    rows, columns = numpy.nonzero(anomalies)
+
+    # Gather the flagged experimental values. With mixed column types, gather column by column
+    # so every value keeps its own column's type, as reading it cell by cell would.
+    if experimental.dtypes.nunique() <= 1:
+        values = experimental.to_numpy()[rows, columns]
+    else:
+        values = numpy.empty(len(rows), dtype=object)
+        order = numpy.argsort(columns, kind="stable")
+        starts = numpy.searchsorted(columns[order], numpy.arange(experimental.shape[1] + 1))
+        for column in range(experimental.shape[1]):
+            inColumn = order[starts[column]:starts[column + 1]]
+            if len(inColumn):
+                values[inColumn] = experimental.iloc[:, column].to_numpy()[rows[inColumn]]
+    return rows, columns, values
+
+
+def findAnomalies(normalizedData, experimental, acceptableThreshold):
+    """
+    The findAnomalies() function selects the values whose ratio lies at or beyond
+    acceptableThreshold from 1, in either direction.
+
+    Arguments:
+        normalizedData (DataFrame):  A DataFrame containing the normalized data (ratio of
+                                     experimental to control data).
+        experimental (DataFrame):    A DataFrame containing the experimental data.
+        acceptableThreshold (float): How far from 1 a ratio may be before it is an anomaly.
+
+    Returns:
+        withinthreshold (list): A list of tuples containing the accepted values and their
+                                original cell locations in the experimental data.
+    """
+    rows, columns, values = findAnomalyArrays(normalizedData, experimental, acceptableThreshold)
+
+    # Label only the flagged cells, using a precomputed column-letter table.
+    letters = columnLetters(normalizedData.shape[1])
+    withinthreshold = [(value, f"{letters[column]}{row + 1}")
+                       for value, row, column in zip(values.tolist(), rows.tolist(), columns.tolist())]
     return withinthreshold
 
 # 
@@ -137,6 +478,147 @@ def outputFile(withinthreshold, outputFilename):
     df = pandas.DataFrame(withinthreshold, columns=["Value", "Cell"])
     df.to_csv(outputFilename, index=False)
 
+
+# Large runs can flag millions of cells, so anomalies can also be saved as typed arrays, with no
+# "A1"-style labels to format: a structured .npy file, or a Parquet file.
+BINARY_OUTPUTS = (".npy", ".parquet")
+
+
+def isBinaryOutput(outputFilename):
+    """
+    The isBinaryOutput() function tells whether anomalies written to outputFilename are saved
+    as typed arrays (.npy or .parquet) rather than as a CSV file.
+    """
+    return os.path.splitext(outputFilename)[1].lower() in BINARY_OUTPUTS
+
+
+def writeAnomalyArrays(rows, columns, values, outputFilename):
+    """
+    The writeAnomalyArrays() function saves anomalies as three typed columns, Row, Column and
+    Value, where Row and Column are zero-based. A .npy file holds one structured array, which
+    readAnomalies() can memory-map; any other extension is written as Parquet.
+
+    Values of sheets whose columns have different types are stored as floats.
+
+    Arguments:
+        rows (ndarray):        The zero-based row of every anomaly.
+        columns (ndarray):     The zero-based column of every anomaly.
+        values (ndarray):      The experimental value of every anomaly.
+        outputFilename (str):  The filename for the output .npy or .parquet file.
+    """
+    values = numpy.asarray(values)
+    if values.dtype == object:
+        values = values.astype(float)
+
+    if os.path.splitext(outputFilename)[1].lower() == ".npy":
+        records = numpy.empty(len(rows), dtype=[("Row", numpy.uint32), ("Column", numpy.uint32), ("Value", values.dtype)])
+        records["Row"] = rows
+        records["Column"] = columns
+        records["Value"] = values
+        numpy.save(outputFilename, records)
+    else:
+        pandas.DataFrame({"Row": numpy.asarray(rows, dtype=numpy.uint32), "Column": numpy.asarray(columns, dtype=numpy.uint32),
+                          "Value": values}).to_parquet(outputFilename, index=False)
+
+
+def writeAnomalyBlocks(blocks, outputFilename, valueType):
+    """
+    The writeAnomalyBlocks() function saves anomalies in the same format as
+    writeAnomalyArrays(), but writes each block as it arrives, so only one block is in memory
+    at a time. Parquet files get one row group per block; the records of a .npy file are
+    written to a temporary file first, since its header holds the number of records.
+
+    Arguments:
+        blocks (iterator):     The (rows, columns, values) blocks yielded by chunkAnomalies().
+        outputFilename (str):  The filename for the output .npy or .parquet file.
+        valueType (dtype):     The type of the values across all blocks; objects are stored as floats.
+
+    Returns:
+        nAnomalies (int): The number of anomalies written.
+    """
+    valueType = numpy.dtype(valueType)
+    if valueType == object:
+        valueType = numpy.dtype(float)
+    recordType = numpy.dtype([("Row", numpy.uint32), ("Column", numpy.uint32), ("Value", valueType)])
+    nAnomalies = 0
+
+    if os.path.splitext(outputFilename)[1].lower() == ".npy":
+        temporaryPath = outputFilename + ".tmp"
+        with open(temporaryPath, "wb") as file:
+            for rows, columns, values in blocks:
+                records = numpy.empty(len(rows), dtype=recordType)
+                records["Row"] = rows
+                records["Column"] = columns
+                records["Value"] = values
+                file.write(records.tobytes())
+                nAnomalies += len(records)
+        header = {"descr": numpy.lib.format.dtype_to_descr(recordType), "fortran_order": False, "shape": (nAnomalies,)}
+        with open(outputFilename, "wb") as file, open(temporaryPath, "rb") as records:
+            numpy.lib.format.write_array_header_1_0(file, header)
+            shutil.copyfileobj(records, file)
+        os.remove(temporaryPath)
+        return nAnomalies
+
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([("Row", pyarrow.uint32()), ("Column", pyarrow.uint32()),
+                             ("Value", pyarrow.from_numpy_dtype(valueType))])
+    with pyarrow.parquet.ParquetWriter(outputFilename, schema) as writer:
+        for rows, columns, values in blocks:
+            writer.write_table(pyarrow.table([numpy.asarray(rows, dtype=numpy.uint32), numpy.asarray(columns, dtype=numpy.uint32),
+                                              numpy.asarray(values, dtype=valueType)], schema=schema))
+            nAnomalies += len(rows)
+    return nAnomalies
+
+
+def readAnomalies(filename):
+    """
+    The readAnomalies() function loads anomalies saved by writeAnomalyArrays() without copying
+    them: a .npy file is memory-mapped, and Parquet columns are handed over by pyarrow.
+
+    Arguments:
+        filename (str): The .npy or .parquet file to load.
+
+    Returns:
+        rows (ndarray):    The zero-based row of every anomaly.
+        columns (ndarray): The zero-based column of every anomaly.
+        values (ndarray):  The experimental value of every anomaly.
+    """
+    if os.path.splitext(filename)[1].lower() == ".npy":
+        records = numpy.load(filename, mmap_mode="r")
+        return records["Row"], records["Column"], records["Value"]
+
+    import pyarrow.parquet
+
+    table = pyarrow.parquet.read_table(filename)
+    return tuple(table.column(name).to_numpy() for name in ("Row", "Column", "Value"))
+
+
+def exportAnomaliesCsv(anomalyFilename, csvFilename, chunkRows=10**6):
+    """
+    The exportAnomaliesCsv() function turns anomalies saved by writeAnomalyArrays() into the
+    same Value/Cell CSV file that outputFile() writes. Cell labels are only formatted here, a
+    block of chunkRows anomalies at a time, so the whole output never has to be held as strings.
+
+    Arguments:
+        anomalyFilename (str): The .npy or .parquet file to export.
+        csvFilename (str):     The filename for the output CSV file.
+        chunkRows (int):       The number of anomalies labelled at a time. Default is 10^6.
+
+    Returns:
+        nAnomalies (int): The number of anomalies written.
+    """
+    rows, columns, values = readAnomalies(anomalyFilename)
+    letters = columnLetters(int(columns.max()) + 1 if len(columns) else 0)
+
+    pandas.DataFrame(columns=["Value", "Cell"]).to_csv(csvFilename, index=False)
+    for start in range(0, len(rows), chunkRows):
+        stop = start + chunkRows
+        cells = [f"{letters[column]}{row + 1}" for row, column in zip(rows[start:stop].tolist(), columns[start:stop].tolist())]
+        pandas.DataFrame({"Value": values[start:stop], "Cell": cells}).to_csv(csvFilename, mode="a", header=False, index=False)
+    return len(rows)
+
 def getMultiplierAndFolds():
     """
     The getMultiplierAndFolds() function asks the user if they have a specified threshold multiplier
@@ -185,7 +667,7 @@ def getMultiplierAndFolds():
 
 
 
-def processFiles(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=5):
+def processFiles(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=5, chunkRows=None, incremental=False, policy="skip"):
     """
     The processFiles() function processes the provided control and experimental files,
     normalizes the data, applies a threshold to identify anomalies, and writes the
@@ -196,16 +678,40 @@ def processFiles(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=
                                    <filename>.<file extension>.
         experimentalFile (str):    The filename for the experimental Excel file. It has format
                                    <filename>.<file extension>.
-        outFile (str):             The filename for the output CSV file. It has format
-                                   <filename>.<file extension>.
+        outFile (str):             The filename for the output file. It has format
+                                   <filename>.<file extension>; .npy and .parquet files are
+                                   written by writeAnomalyArrays(), anything else as CSV.
         multiplier (float):        A multiplier to adjust the threshold value for the
                                    threshold() function. Default is 1.0.
         nFolds (int):              The number of folds to use in cross-validation in the 
                                    threshold() function. Default is 5.
+        chunkRows (int):           When given, process the files in blocks of this many rows
+                                   with processFilesStreaming(). Default is None (all at once).
+        incremental (bool):        Only process rows appended since the last call, with
+                                   processFilesIncremental(). Default is False.
+        policy (str):              How to treat zero or missing controls: "skip", "flag" or
+                                   "impute" (see safeDivide()). Default is "skip".
 
+    Returns:
+        nAnomalies (int): The number of anomalies written to the output file.
     """
+    # Growing sheets are processed incrementally, and sheets too large for memory are streamed
+    if incremental:
+        return processFilesIncremental(controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows or 10000, policy=policy)
+    if chunkRows is not None:
+        return processFilesStreaming(controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows, policy)
+
     # Normalize the data using the provided control and experimental files
-    normalizedData, experimentalData = normalize(controlFile, experimentalFile)
+    normalizedData, experimentalData = normalize(controlFile, experimentalFile, policy=policy)
+    describeNormalization(experimentalFile, normalizedData.attrs["normalization"])
+
+    # Binary output skips labelling: fit the threshold and save the flagged cells as typed arrays
+    if isBinaryOutput(outFile):
+        data = pandas.DataFrame({"Experimental": experimentalData.values.flatten(), "Ratio": normalizedData.values.flatten()})
+        acceptableThreshold = findThreshold(data, multiplier, nFolds)
+        rows, columns, values = findAnomalyArrays(normalizedData, experimentalData, acceptableThreshold)
+        writeAnomalyArrays(rows, columns, values, outFile)
+        return len(rows)
 
     # Apply a threshold to identify anomalies
     withinThreshold = threshold(normalizedData, experimentalData, multiplier, nFolds)
@@ -213,6 +719,680 @@ def processFiles(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=
     # Write the results to an output file
     outputFile(withinThreshold, outFile)
 
+    return len(withinThreshold)
+
+
+# Streaming mode: sheets too large for memory are read and processed a block of rows at a time.
+def iterSheetChunks(filename, chunkRows, startRow=0):
+    """
+    The iterSheetChunks() function reads a sheet a block of rows at a time, so that only one
+    block is in memory at once. It accepts the same formats as readSheet(); .xlsx files are
+    streamed with openpyxl's read-only mode instead of going through the parsed-sheet cache,
+    while .xls files, which openpyxl cannot read, are parsed whole by readSheet().
+
+    Arguments:
+        filename (string): The file to read; it has format <filename>.<file extension>.
+        chunkRows (int):   The number of rows per block.
+        startRow (int):    The zero-based row to start reading at. Default is 0.
+
+    Yields:
+        chunk (ndarray): The next block of rows, with empty cells as NaN.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        try:
+            chunks = pandas.read_csv(filename, header = None, chunksize=chunkRows, skiprows=startRow)
+        except pandas.errors.EmptyDataError:
+            # No rows at or after startRow.
+            return
+        for chunk in chunks:
+            yield chunk.to_numpy()
+    elif extension == ".npy":
+        sheet = numpy.load(filename, mmap_mode="r")
+        for start in range(startRow, sheet.shape[0], chunkRows):
+            yield numpy.asarray(sheet[start:start + chunkRows])
+    elif extension == ".parquet":
+        import pyarrow.parquet
+        # Row groups that end before startRow are skipped using the file's metadata, unread.
+        parquetFile = pyarrow.parquet.ParquetFile(filename)
+        firstGroup, skip = 0, startRow
+        while firstGroup < parquetFile.num_row_groups and skip >= parquetFile.metadata.row_group(firstGroup).num_rows:
+            skip -= parquetFile.metadata.row_group(firstGroup).num_rows
+            firstGroup += 1
+        rowGroups = range(firstGroup, parquetFile.num_row_groups)
+        for batch in parquetFile.iter_batches(batch_size=chunkRows, row_groups=rowGroups):
+            if skip >= batch.num_rows:
+                skip -= batch.num_rows
+                continue
+            yield batch.slice(skip).to_pandas().to_numpy()
+            skip = 0
+    elif extension == ".xls":
+        # openpyxl cannot read the old binary format, so .xls sheets are parsed whole by
+        # readSheet() and only handed out a block at a time.
+        sheet = readSheet(filename).to_numpy()
+        for start in range(startRow, sheet.shape[0], chunkRows):
+            yield sheet[start:start + chunkRows]
+    else:
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            if sheet.max_column is None:
+                # Some writers leave out the sheet's dimension; scan it once to find the width.
+                sheet.calculate_dimension(force=True)
+            rows = []
+            for row in sheet.iter_rows(min_row=startRow + 1, values_only=True):
+                rows.append(row)
+                if len(rows) == chunkRows:
+                    yield rowsToArray(rows, sheet.max_column)
+                    rows = []
+            if rows:
+                yield rowsToArray(rows, sheet.max_column)
+        finally:
+            workbook.close()
+
+
+def rowsToArray(rows, width):
+    """
+    The rowsToArray() function turns rows of cell values read by openpyxl into an array, the
+    way pandas would read them: empty cells become NaN and whole-number sheets stay integers.
+
+    Arguments:
+        rows (list):  A list of tuples of cell values.
+        width (int):  The number of columns in the sheet; shorter rows are padded with NaN.
+
+    Returns:
+        chunk (ndarray): The rows as a two-dimensional array.
+    """
+    frame = pandas.DataFrame([row + (None,) * (width - len(row)) for row in rows])
+    chunk = frame.to_numpy()
+    if chunk.dtype == object:
+        chunk = frame.to_numpy(dtype=float, na_value=numpy.nan)
+    return chunk
+
+
+def streamFolds(flatIndex, nFolds):
+    """
+    The streamFolds() function assigns cells to cross-validation folds by hashing their
+    position in the sheet (row * number of columns + column). Unlike a shuffled KFold it
+    needs no permutation of the whole sheet, so it works a block at a time, and a cell
+    always lands in the same fold however the sheet is split into blocks.
+
+    Arguments:
+        flatIndex (ndarray): The row-major positions of the cells.
+        nFolds (int):        The number of folds.
+
+    Returns:
+        fold (ndarray): The fold of every cell, from 0 to nFolds - 1.
+    """
+    hashed = numpy.asarray(flatIndex, dtype=numpy.uint64) * numpy.uint64(0x9E3779B97F4A7C15)
+    hashed ^= hashed >> numpy.uint64(29)
+    return (hashed % numpy.uint64(nFolds)).astype(numpy.intp)
+
+
+class RunningFoldStats:
+    """
+    The RunningFoldStats class accumulates, fold by fold, the sums needed to fit and score a
+    one-feature linear regression (count, x, y, x*x, x*y and y*y), so that the cross-validated
+    RMSE of findThreshold() can be computed from data seen one block at a time. Values are
+    shifted by the mean of the first block to keep the sums of squares precise.
+
+    Arguments:
+        nFolds (int): The number of folds. Default is 5.
+    """
+    def __init__(self, nFolds=5):
+        self.nFolds = nFolds
+        self.shift = None
+        # Rows: count, x, y, x*x, x*y, y*y. Columns: folds.
+        self.sums = numpy.zeros((6, nFolds))
+
+    def update(self, x, y, flatIndex):
+        """
+        The update() method adds a block of (experimental, ratio) pairs to the sums. Pairs
+        where either value is missing or infinite are left out, as they cannot be fitted.
+
+        Arguments:
+            x (ndarray):         The experimental values of the block.
+            y (ndarray):         The ratios of the block.
+            flatIndex (ndarray): The row-major positions of the block's cells in the sheet.
+        """
+        x = numpy.asarray(x, dtype=float).ravel()
+        y = numpy.asarray(y, dtype=float).ravel()
+        finite = numpy.isfinite(x) & numpy.isfinite(y)
+        x, y = x[finite], y[finite]
+        if len(x) == 0:
+            return
+        if self.shift is None:
+            self.shift = (x.mean(), y.mean())
+        x = x - self.shift[0]
+        y = y - self.shift[1]
+
+        fold = streamFolds(numpy.asarray(flatIndex).ravel()[finite], self.nFolds)
+        for row, weights in enumerate((None, x, y, x * x, x * y, y * y)):
+            self.sums[row] += numpy.bincount(fold, weights=weights, minlength=self.nFolds)
+
+    def toDict(self):
+        """
+        The toDict() method returns the accumulated sums as plain values that can be saved as JSON.
+
+        Returns:
+            state (dict): The number of folds, the shift and the sums.
+        """
+        return {"nFolds": self.nFolds, "shift": None if self.shift is None else [float(v) for v in self.shift],
+                "sums": self.sums.tolist()}
+
+    @classmethod
+    def fromDict(cls, state):
+        """
+        The fromDict() method rebuilds accumulated sums saved with toDict().
+
+        Arguments:
+            state (dict): The dictionary returned by toDict().
+
+        Returns:
+            stats (RunningFoldStats): The restored sums, ready for more update() calls.
+        """
+        stats = cls(state["nFolds"])
+        stats.shift = None if state["shift"] is None else tuple(state["shift"])
+        stats.sums = numpy.array(state["sums"], dtype=float)
+        return stats
+
+    def avgRmse(self):
+        """
+        The avgRmse() method fits each fold's training set (every other fold) from the sums and
+        scores it on the fold, without going back to the data.
+
+        Returns:
+            avgRmse (float): The RMSE averaged over the folds.
+        """
+        count, sx, sy, sxx, sxy, syy = self.sums
+        if (count == 0).any():
+            raise ValueError(f"Not enough values to fill {self.nFolds} folds.")
+        trainN, trainX, trainY, trainXX, trainXY = [total.sum() - total for total in (count, sx, sy, sxx, sxy)]
+
+        # Least-squares line of each training set.
+        meanX = trainX / trainN
+        meanY = trainY / trainN
+        varianceX = trainXX - trainN * meanX ** 2
+        covariance = trainXY - trainN * meanX * meanY
+        slope = numpy.divide(covariance, varianceX, out=numpy.zeros(self.nFolds), where=varianceX > 0)
+        intercept = meanY - slope * meanX
+
+        # Mean squared residual of each fold, expanded in terms of its sums.
+        squared = (syy - 2 * intercept * sy - 2 * slope * sxy + count * intercept ** 2
+                   + 2 * intercept * slope * sx + slope ** 2 * sxx)
+        mse = numpy.maximum(squared / count, 0)
+        return numpy.sqrt(mse).mean()
+
+
+def alignedChunks(controlFilename, experimentalFilename, chunkRows, startRow=0):
+    """
+    The alignedChunks() function reads the control and experimental sheets side by side, a
+    block of rows at a time, checking that the two sheets have the same shape.
+
+    Arguments:
+        controlFilename (string):      The filename for the control sheet.
+        experimentalFilename (string): The filename for the experimental sheet.
+        chunkRows (int):               The number of rows per block.
+        startRow (int):                The zero-based row to start reading at. Default is 0.
+
+    Yields:
+        firstRow (int):          The zero-based row of the sheet the block starts at.
+        control (ndarray):       The control values of the block.
+        experimental (ndarray):  The experimental values of the block.
+    """
+    firstRow = startRow
+    controls = iterSheetChunks(controlFilename, chunkRows, startRow)
+    experimentals = iterSheetChunks(experimentalFilename, chunkRows, startRow)
+    for control, experimental in itertools.zip_longest(controls, experimentals):
+        if control is None or experimental is None or control.shape != experimental.shape:
+            raise ValueError("The control and experimental sheets do not have the same shape.")
+        yield firstRow, control, experimental
+        firstRow += control.shape[0]
+
+
+def processFilesStreaming(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=5, chunkRows=10000, policy="skip"):
+    """
+    The processFilesStreaming() function does the same job as processFiles() while keeping only
+    one block of chunkRows rows in memory. A first pass over the sheets accumulates the
+    regression sums for the threshold; a second pass flags the anomalies of each block and
+    appends them to the output file.
+
+    Folds are assigned by streamFolds() rather than by a shuffled KFold, so the threshold
+    agrees with processFiles() statistically rather than to the last digit.
+
+    Arguments:
+        controlFile (str):      The filename for the control file.
+        experimentalFile (str): The filename for the experimental file.
+        outFile (str):          The filename for the output CSV, .npy or .parquet file. Binary
+                                output is written a block at a time by writeAnomalyBlocks().
+        multiplier (float):     A multiplier to adjust the threshold value. Default is 1.0.
+        nFolds (int):           The number of folds to use in cross-validation. Default is 5.
+        chunkRows (int):        The number of rows per block. Default is 10000.
+        policy (str):           How to treat zero or missing controls (see safeDivide()). With
+                                "impute", medians are taken per block. Default is "skip".
+
+    Returns:
+        nAnomalies (int): The number of anomalies written to the output file.
+    """
+    # First pass: accumulate the regression sums over every block.
+    stats = RunningFoldStats(nFolds)
+    _, counts, valueType = accumulateChunks(stats, alignedChunks(controlFile, experimentalFile, chunkRows), policy)
+    describeNormalization(experimentalFile, counts)
+    acceptableThreshold = stats.avgRmse() * multiplier
+
+    # Second pass: flag each block's anomalies and append them to the output file.
+    if isBinaryOutput(outFile):
+        return writeAnomalyBlocks(chunkAnomalies(alignedChunks(controlFile, experimentalFile, chunkRows), acceptableThreshold, policy),
+                                  outFile, valueType)
+    pandas.DataFrame(columns=["Value", "Cell"]).to_csv(outFile, index=False)
+    return appendAnomalies(alignedChunks(controlFile, experimentalFile, chunkRows), outFile, acceptableThreshold, policy)
+
+
+def accumulateChunks(stats, chunks, policy="skip"):
+    """
+    The accumulateChunks() function adds every block from alignedChunks() to running
+    regression sums.
+
+    Arguments:
+        stats (RunningFoldStats): The sums to add to.
+        chunks (iterator):        The blocks yielded by alignedChunks().
+        policy (str):             How to treat zero or missing controls (see safeDivide()).
+                                  Default is "skip".
+
+    Returns:
+        nRows (int):       The row just past the last block, or None if there were no blocks.
+        counts (dict):     The safeDivide() counts added up over the blocks.
+        valueType (dtype): The type that holds the experimental values of every block.
+    """
+    nRows = None
+    counts = {}
+    valueType = None
+    for firstRow, control, experimental in chunks:
+        valueType = experimental.dtype if valueType is None else numpy.result_type(valueType, experimental.dtype)
+        ratio, chunkCounts = safeDivide(experimental, control, policy)
+        for name, value in chunkCounts.items():
+            counts[name] = counts.get(name, 0) + value
+        flatIndex = firstRow * control.shape[1] + numpy.arange(control.size)
+        stats.update(experimental, ratio, flatIndex)
+        nRows = firstRow + control.shape[0]
+    return nRows, counts, numpy.dtype(float) if valueType is None else valueType
+
+
+def appendAnomalies(chunks, outFile, acceptableThreshold, policy="skip"):
+    """
+    The appendAnomalies() function flags the anomalies of every block from alignedChunks() and
+    appends them, without a header, to an output CSV file.
+
+    Arguments:
+        chunks (iterator):           The blocks yielded by alignedChunks().
+        outFile (str):               The filename for the output CSV file.
+        acceptableThreshold (float): How far from 1 a ratio may be before it is an anomaly.
+        policy (str):                How to treat zero or missing controls (see safeDivide()).
+                                     Default is "skip".
+
+    Returns:
+        nAnomalies (int): The number of anomalies appended.
+    """
+    nAnomalies = 0
+    letters = []
+    for rows, columns, values in chunkAnomalies(chunks, acceptableThreshold, policy):
+        if len(columns) and columns.max() >= len(letters):
+            letters = columnLetters(int(columns.max()) + 1)
+        cells = [f"{letters[column]}{row + 1}" for row, column in zip(rows.tolist(), columns.tolist())]
+        block = pandas.DataFrame({"Value": values, "Cell": cells})
+        block.to_csv(outFile, mode="a", header=False, index=False)
+        nAnomalies += len(block)
+    return nAnomalies
+
+
+def chunkAnomalies(chunks, acceptableThreshold, policy="skip"):
+    """
+    The chunkAnomalies() function flags the anomalies of every block from alignedChunks().
+
+    Arguments:
+        chunks (iterator):           The blocks yielded by alignedChunks().
+        acceptableThreshold (float): How far from 1 a ratio may be before it is an anomaly.
+        policy (str):                How to treat zero or missing controls (see safeDivide()).
+                                     Default is "skip".
+
+    Yields:
+        rows (ndarray):    The zero-based sheet row of every anomaly in the block.
+        columns (ndarray): The zero-based column of every anomaly in the block.
+        values (ndarray):  The experimental value of every anomaly in the block.
+    """
+    lowerBound = 1 - acceptableThreshold
+    upperBound = 1 + acceptableThreshold
+    for firstRow, control, experimental in chunks:
+        ratio, _ = safeDivide(experimental, control, policy)
+        rows, columns = numpy.nonzero((ratio <= lowerBound) | (ratio >= upperBound))
+        yield firstRow + rows, columns, experimental[rows, columns]
+
+
+# Incremental mode recognizes a replaced sheet by the last rows it processed, so the check
+# costs the same however long the sheet has grown.
+TAIL_ROWS = 16
+
+
+def tailDigests(controlFile, experimentalFile, nRows):
+    """
+    The tailDigests() function hashes the last TAIL_ROWS rows of the first nRows rows of the
+    control and experimental sheets. Only those rows are read, so for .npy and .parquet sheets
+    the cost does not grow with nRows.
+
+    Arguments:
+        controlFile (str):      The filename for the control file.
+        experimentalFile (str): The filename for the experimental file.
+        nRows (int):            The number of rows processed so far.
+
+    Returns:
+        digests (dict): The hexadecimal digest of the rows of "control" and of "experimental",
+                        or None if the sheets have fewer than nRows rows.
+    """
+    startRow = max(nRows - TAIL_ROWS, 0)
+    digests = {"control": hashlib.sha1(), "experimental": hashlib.sha1()}
+    rowsRead = startRow
+    # Blocks can be shorter than asked for, e.g. at a Parquet row group boundary.
+    for _, control, experimental in alignedChunks(controlFile, experimentalFile, TAIL_ROWS, startRow):
+        take = nRows - rowsRead
+        # The rows are hashed as floats, so whole numbers hash the same whether or not a block
+        # was read as integers.
+        digests["control"].update(numpy.ascontiguousarray(control[:take], dtype=float).tobytes())
+        digests["experimental"].update(numpy.ascontiguousarray(experimental[:take], dtype=float).tobytes())
+        rowsRead += min(take, control.shape[0])
+        if rowsRead == nRows:
+            return {name: digest.hexdigest() for name, digest in digests.items()}
+    return None
+
+
+def processFilesIncremental(controlFile, experimentalFile, outFile, multiplier=1.0, nFolds=5, chunkRows=10000, stateFile=None, policy="skip"):
+    """
+    The processFilesIncremental() function keeps an output file up to date while rows are
+    appended to the control and experimental sheets. It saves the running regression sums and
+    the number of rows processed in a state file, and on every call reads only the rows added
+    since the last call: it adds them to the sums, recomputes the threshold and appends only
+    their anomalies to the output file. Anomalies already written are not revisited when the
+    threshold moves. Folds are assigned as in processFilesStreaming().
+
+    The state also records a hash of the last TAIL_ROWS rows processed in each sheet. If a
+    sheet has shrunk or those rows changed, e.g. because it was replaced rather than appended
+    to, the output file is started over from the first row. Changes further up a sheet are not
+    noticed; delete the state file (or the output file) to start over by hand.
+
+    Arguments:
+        controlFile (str):      The filename for the control file.
+        experimentalFile (str): The filename for the experimental file.
+        outFile (str):          The filename for the output CSV file. Binary outputs cannot be
+                                appended to, so .npy and .parquet raise a ValueError.
+        multiplier (float):     A multiplier to adjust the threshold value. Default is 1.0.
+        nFolds (int):           The number of folds to use in cross-validation. Default is 5.
+        chunkRows (int):        The number of rows per block. Default is 10000.
+        stateFile (str):        The filename for the saved state. Default is outFile + ".state.json".
+        policy (str):           How to treat zero or missing controls (see safeDivide()). With
+                                "impute", medians are taken per block. Default is "skip".
+
+    Returns:
+        nAnomalies (int): The number of new anomalies appended to the output file.
+    """
+    if isBinaryOutput(outFile):
+        raise ValueError(f"Incremental mode appends to a CSV file and cannot write {outFile}.")
+    if stateFile is None:
+        stateFile = outFile + ".state.json"
+
+    # Pick up where the last call stopped, unless the state belongs to other settings or files.
+    settings = {"control": os.path.abspath(controlFile), "experimental": os.path.abspath(experimentalFile),
+                "multiplier": multiplier, "nFolds": nFolds, "policy": policy}
+    state = None
+    if os.path.exists(stateFile) and os.path.exists(outFile):
+        with open(stateFile) as file:
+            state = json.load(file)
+        if state["settings"] != settings:
+            state = None
+
+    # Only rows appended since the last call are new; a sheet that shrank or changed its last
+    # processed rows was replaced, and its old anomalies no longer apply.
+    if state is not None:
+        digests = tailDigests(controlFile, experimentalFile, state["rowsProcessed"])
+        if digests is None or digests != state.get("digests"):
+            print(f"{os.path.basename(experimentalFile)}: the sheets changed since the last run; starting over")
+            state = None
+    if state is None:
+        state = {"settings": settings, "rowsProcessed": 0, "stats": RunningFoldStats(nFolds).toDict()}
+        pandas.DataFrame(columns=["Value", "Cell"]).to_csv(outFile, index=False)
+    startRow = state["rowsProcessed"]
+
+    # Add only the new rows to the sums, then flag only the new rows.
+    stats = RunningFoldStats.fromDict(state["stats"])
+    nRows, counts, _ = accumulateChunks(stats, alignedChunks(controlFile, experimentalFile, chunkRows, startRow), policy)
+    if nRows is None:
+        # Nothing was appended since the last call.
+        return 0
+    describeNormalization(experimentalFile, counts)
+    acceptableThreshold = stats.avgRmse() * multiplier
+    nAnomalies = appendAnomalies(alignedChunks(controlFile, experimentalFile, chunkRows, startRow), outFile, acceptableThreshold, policy)
+
+    # Save the new state under a temporary name first, so an interruption never leaves it half written.
+    state["rowsProcessed"] = nRows
+    state["stats"] = stats.toDict()
+    state["digests"] = tailDigests(controlFile, experimentalFile, nRows)
+    temporaryPath = stateFile + ".tmp"
+    with open(temporaryPath, "w") as file:
+        json.dump(state, file)
+    os.replace(temporaryPath, stateFile)
+    return nAnomalies
+
+
+def countAnomalies(sortedRatios, acceptableThreshold):
+    """
+    The countAnomalies() function counts how many ratios findAnomalies() would flag for a
+    threshold, by binary search in the sorted ratios instead of scanning them.
+
+    Arguments:
+        sortedRatios (ndarray):      The ratios of a sheet without NaNs, in ascending order.
+        acceptableThreshold (float): How far from 1 a ratio may be before it is an anomaly.
+
+    Returns:
+        nAnomalies (int): The number of ratios at or below 1 - threshold or at or above 1 + threshold.
+    """
+    lowerBound = 1 - acceptableThreshold
+    upperBound = 1 + acceptableThreshold
+    # When the bounds meet or cross, every ratio is on one side of them or the other.
+    if lowerBound >= upperBound:
+        return len(sortedRatios)
+    below = numpy.searchsorted(sortedRatios, lowerBound, side="right")
+    above = len(sortedRatios) - numpy.searchsorted(sortedRatios, upperBound, side="left")
+    return int(below + above)
+
+
+def sweep(controlFile, experimentalFile, multipliers, foldCounts, outputPattern=None, policy="skip"):
+    """
+    The sweep() function reports how many anomalies every combination of multiplier and number
+    of folds would find. Since the threshold is the average RMSE times the multiplier, the files
+    are read once, the RMSE is computed once per number of folds, the ratios are sorted once,
+    and each combination is then counted by binary search.
+
+    Arguments:
+        controlFile (str):      The filename for the control file.
+        experimentalFile (str): The filename for the experimental file.
+        multipliers (list):     The threshold multipliers to try.
+        foldCounts (list):      The numbers of folds to try.
+        outputPattern (str):    When given, also write each combination's anomalies to the CSV,
+                                .npy or .parquet file outputPattern.format(multiplier=..., folds=...).
+                                Default is None (counts only).
+        policy (str):           How to treat zero or missing controls (see safeDivide()).
+                                Default is "skip".
+
+    Returns:
+        results (DataFrame): One row per combination, with the multiplier, number of folds,
+                             average RMSE, threshold and number of anomalies.
+    """
+    normalizedData, experimental = normalize(controlFile, experimentalFile, policy=policy)
+    describeNormalization(experimentalFile, normalizedData.attrs["normalization"])
+    x = experimental.to_numpy(dtype=float).ravel()
+    y = normalizedData.to_numpy(dtype=float).ravel()
+    sortedRatios = numpy.sort(y[~numpy.isnan(y)])
+
+    # Only cells with a finite ratio and value take part in the fit, as in findThreshold().
+    finite = numpy.isfinite(x) & numpy.isfinite(y)
+    x, y = x[finite], y[finite]
+
+    results = []
+    for nFolds in foldCounts:
+        avgRmse = kFoldRmse(x, y, nFolds)
+        for multiplier in multipliers:
+            acceptableThreshold = avgRmse * multiplier
+            if outputPattern is not None:
+                outputFilename = outputPattern.format(multiplier=multiplier, folds=nFolds)
+                if isBinaryOutput(outputFilename):
+                    writeAnomalyArrays(*findAnomalyArrays(normalizedData, experimental, acceptableThreshold), outputFilename)
+                else:
+                    outputFile(findAnomalies(normalizedData, experimental, acceptableThreshold), outputFilename)
+            results.append({"multiplier": multiplier, "folds": nFolds, "avgRmse": avgRmse,
+                            "threshold": acceptableThreshold,
+                            "anomalies": countAnomalies(sortedRatios, acceptableThreshold)})
+    return pandas.DataFrame(results)
+
+
+def readManifest(manifestFilename):
+    """
+    The readManifest() function reads the list of experiments to process in a batch from a CSV
+    manifest with the columns "control", "experimental" and "output". Relative paths in the
+    manifest are taken relative to the manifest's own folder. Blank cells become None, so that
+    the batch reports that pair as failed instead of stopping.
+
+    Arguments:
+        manifestFilename (str): The filename for the manifest CSV file.
+
+    Returns:
+        pairs (list): A list of (controlFile, experimentalFile, outFile) tuples.
+    """
+    manifest = pandas.read_csv(manifestFilename, dtype=str)
+    baseDir = os.path.dirname(os.path.abspath(manifestFilename))
+    return [tuple(None if pandas.isna(filename) else os.path.join(baseDir, filename) for filename in row)
+            for row in manifest[["control", "experimental", "output"]].itertuples(index=False)]
+
+
+def pairsFromGlob(controlPattern, experimentalPattern, outputPattern):
+    """
+    The pairsFromGlob() function matches control files with experimental files by the parts of
+    their names the "*" wildcards stand for. For example, the patterns
+    "Exam_control measurements*.xlsx", "Exam_experimental_measurements*.xlsx" and
+    "Experiment * Anomalies.csv" pair "Exam_control measurements1.xlsx" with
+    "Exam_experimental_measurements1.xlsx" and write "Experiment 1 Anomalies.csv".
+
+    A control file without a matching experimental file is still returned, with None as its
+    experimental file, and likewise an experimental file without a matching control file, so
+    that the batch reports them instead of silently skipping them.
+
+    Arguments:
+        controlPattern (str):      The glob pattern for the control files.
+        experimentalPattern (str): The glob pattern for the experimental files, with the same
+                                   number of "*" wildcards.
+        outputPattern (str):       The output filename, with the same number of "*" wildcards.
+
+    Returns:
+        pairs (list): A list of (controlFile, experimentalFile, outFile) tuples.
+    """
+    def wildcardParts(pattern):
+        regex = "(.*)".join(re.escape(part) for part in pattern.split("*"))
+        matches = {}
+        for filename in glob.glob(pattern):
+            match = re.fullmatch(regex, filename)
+            if match:
+                matches[match.groups()] = filename
+        return matches
+
+    controls = wildcardParts(controlPattern)
+    experimentals = wildcardParts(experimentalPattern)
+
+    pairs = []
+    for parts in sorted(controls.keys() | experimentals.keys()):
+        outParts = iter(parts)
+        outFile = re.sub(r"\*", lambda _: next(outParts, ""), outputPattern)
+        pairs.append((controls.get(parts), experimentals.get(parts), outFile))
+    return pairs
+
+
+def processPair(job):
+    """
+    The processPair() function runs processFiles() on one experiment of a batch. Any error is
+    caught and reported in the result, so that one bad file does not abort the whole batch.
+
+    Arguments:
+        job (tuple): (controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows, incremental, policy).
+
+    Returns:
+        result (dict): The files, the number of anomalies (None on error), the seconds taken and
+                       the error message (None on success).
+    """
+    controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows, incremental, policy = job
+    start = time.perf_counter()
+    nAnomalies = None
+    error = None
+    try:
+        if controlFile is None and experimentalFile is None:
+            raise FileNotFoundError("no control or experimental file given")
+        if experimentalFile is None:
+            raise FileNotFoundError(f"no experimental file matches {controlFile}")
+        if controlFile is None:
+            raise FileNotFoundError(f"no control file matches {experimentalFile}")
+        if outFile is None:
+            raise ValueError(f"no output file given for {experimentalFile}")
+        nAnomalies = processFiles(controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows, incremental, policy)
+    except Exception as exception:
+        error = f"{type(exception).__name__}: {exception}"
+    return {"control": controlFile, "experimental": experimentalFile, "output": outFile,
+            "anomalies": nAnomalies, "seconds": time.perf_counter() - start, "error": error}
+
+
+def processBatch(pairs, multiplier=1.0, nFolds=5, maxWorkers=None, chunkRows=None, incremental=False, policy="skip"):
+    """
+    The processBatch() function processes many control/experimental pairs across a pool of
+    worker processes, running at most maxWorkers pairs at a time.
+
+    Arguments:
+        pairs (list):       A list of (controlFile, experimentalFile, outFile) tuples, as
+                            returned by readManifest() or pairsFromGlob().
+        multiplier (float): A multiplier to adjust the threshold value. Default is 1.0.
+        nFolds (int):       The number of folds to use in cross-validation. Default is 5.
+        maxWorkers (int):   The largest number of pairs processed at once. Default is the
+                            number of processors.
+        chunkRows (int):    When given, stream each pair in blocks of this many rows.
+                            Default is None (all at once).
+        incremental (bool): Only process rows appended since the last batch. Default is False.
+        policy (str):       How to treat zero or missing controls (see safeDivide()). Default is "skip".
+
+    Returns:
+        results (list): One processPair() result per pair, in the same order as pairs.
+    """
+    jobs = [(controlFile, experimentalFile, outFile, multiplier, nFolds, chunkRows, incremental, policy) for controlFile, experimentalFile, outFile in pairs]
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        return list(executor.map(processPair, jobs))
+
+
+def printBatchSummary(results, summaryFilename=None):
+    """
+    The printBatchSummary() function prints the timing, anomaly count or error of every pair in
+    a batch, followed by the totals, and optionally saves the same table as a CSV file.
+
+    Arguments:
+        results (list):        The results returned by processBatch().
+        summaryFilename (str): The filename for the summary CSV file. Default is None (no file).
+    """
+    summary = pandas.DataFrame(results, columns=["control", "experimental", "output", "anomalies", "seconds", "error"])
+    for result in results:
+        outcome = f"{result['anomalies']} anomalies" if result["error"] is None else f"FAILED ({result['error']})"
+        name = result["output"] or result["experimental"] or result["control"] or "(blank row)"
+        print(f"{result['seconds']:8.2f} s  {os.path.basename(name)}: {outcome}")
+
+    failed = summary["error"].notna().sum()
+    print(f"{len(results) - failed} of {len(results)} pairs processed, {failed} failed, "
+          f"{int(summary['anomalies'].fillna(0).sum())} anomalies, {summary['seconds'].sum():.2f} s of processing.")
+
+    if summaryFilename is not None:
+        summary.to_csv(summaryFilename, index=False)
+
 """
 Please enter the control and experimental filenames (with file extension), respectively,
 encased in between quotation marks. The same applies for the output filenames.
@@ -221,22 +1401,61 @@ and this file should be executed on that folder.
 Please take below as an example.
 """
 if __name__ == "__main__":
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    # Change your input file filenames here!
-    inputFiles = [
-        (os.path.join(script_dir, "Exam_control measurements1.xlsx"), os.path.join(script_dir, "Exam_experimental_measurements1.xlsx")),
-        (os.path.join(script_dir, "Exam_control measurements2.xlsx"), os.path.join(script_dir, "Exam_experimental_measurements2.xlsx"))
-    ]
-    # Change your output file filenames here!
-    outputFilenames = [
-        os.path.join(script_dir, "Experiment 1 Anomalies.csv"),
-        os.path.join(script_dir, "Experiment 2 Anomalies.csv")
-    ]
-    
-    try:
-        getMultiplierAndFolds()
-    except FileNotFoundError:
-        print("Sorry, the specified file cannot be found. Fix the filename and try again.")
-    except ValueError:
-        print("Your input files do not follow the format. Please fix this.")
+    parser = argparse.ArgumentParser(description="Find anomalies in experimental measurements. "
+                                     "Without a manifest or glob, asks for the settings and processes the files listed below.")
+    parser.add_argument("--manifest", help="CSV with control, experimental and output columns to process as a batch")
+    parser.add_argument("--control-glob", help="glob for the control files of a batch, e.g. \"Exam_control measurements*.xlsx\"")
+    parser.add_argument("--experimental-glob", help="glob for the matching experimental files")
+    parser.add_argument("--output-glob", default="* Anomalies.csv", help="output filename, with one * per wildcard in the input globs; "
+                        "a .npy or .parquet extension saves typed arrays instead of CSV")
+    parser.add_argument("--multiplier", type=float, default=1.0)
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None, help="most pairs processed at once (default: processor count)")
+    parser.add_argument("--summary", help="also write the batch or sweep summary to this CSV file")
+    parser.add_argument("--chunk-rows", type=int, default=None, help="stream each sheet in blocks of this many rows, for sheets too large for memory")
+    parser.add_argument("--incremental", action="store_true", help="only process rows appended since the last run, appending their anomalies")
+    parser.add_argument("--policy", choices=["skip", "flag", "impute"], default="skip",
+                        help="how to treat zero or missing controls: leave the cell out, flag it as an anomaly, or use the column's median control")
+    parser.add_argument("--sweep", nargs=2, metavar=("CONTROL", "EXPERIMENTAL"), help="count anomalies over grids of multipliers and folds")
+    parser.add_argument("--multipliers", type=float, nargs="+", default=[1.0], help="multipliers to sweep")
+    parser.add_argument("--fold-counts", type=int, nargs="+", default=[5], help="numbers of folds to sweep")
+    parser.add_argument("--sweep-output", help="also write every grid point's anomalies, e.g. \"sweep {multiplier} {folds}.csv\"")
+    parser.add_argument("--export-csv", nargs=2, metavar=("ANOMALIES", "CSV"), help="convert a .npy or .parquet anomaly file to a Value/Cell CSV file")
+    args = parser.parse_args()
+
+    if args.export_csv:
+        # Label the cells of a binary anomaly file.
+        print(f"{exportAnomaliesCsv(*args.export_csv)} anomalies written to {args.export_csv[1]}")
+    elif args.sweep:
+        # Parameter sweep over one experiment.
+        results = sweep(args.sweep[0], args.sweep[1], args.multipliers, args.fold_counts, args.sweep_output, args.policy)
+        print(results.to_string(index=False))
+        if args.summary:
+            results.to_csv(args.summary, index=False)
+    elif args.manifest or args.control_glob:
+        # Non-interactive batch mode.
+        if args.manifest:
+            pairs = readManifest(args.manifest)
+        else:
+            pairs = pairsFromGlob(args.control_glob, args.experimental_glob, args.output_glob)
+        results = processBatch(pairs, args.multiplier, args.folds, args.workers, args.chunk_rows, args.incremental, args.policy)
+        printBatchSummary(results, args.summary)
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        # Change your input file filenames here!
+        inputFiles = [
+            (os.path.join(script_dir, "Exam_control measurements1.xlsx"), os.path.join(script_dir, "Exam_experimental_measurements1.xlsx")),
+            (os.path.join(script_dir, "Exam_control measurements2.xlsx"), os.path.join(script_dir, "Exam_experimental_measurements2.xlsx"))
+        ]
+        # Change your output file filenames here!
+        outputFilenames = [
+            os.path.join(script_dir, "Experiment 1 Anomalies.csv"),
+            os.path.join(script_dir, "Experiment 2 Anomalies.csv")
+        ]
 
+        try:
+            getMultiplierAndFolds()
+        except FileNotFoundError:
+            print("Sorry, the specified file cannot be found. Fix the filename and try again.")
+        except ValueError:
+            print("Your input files do not follow the format. Please fix this.")
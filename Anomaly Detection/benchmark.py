@@ -0,0 +1,308 @@
+"""
+Benchmarks for the anomaly detection pipeline, run on synthetic control and experimental sheets.
+Run it from this folder, e.g. "python benchmark.py --sizes 10000 100000 --json results.json", and
+pass "--compare results.json" on a later commit to see what changed.
+"""
+import argparse
+import filecmp
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import openpyxl
+import pandas
+
+import Daniel_Dejud_Data_Science as dds
+
+# Every batch worker imports the script when it starts, so importing it should take no longer than this.
+STARTUP_TARGET_MS = 750
+
+
+def syntheticSheets(nCells, nColumns=100, anomalyRate=0.01, seed=42):
+    """
+    The syntheticSheets() function builds a control sheet and an experimental sheet of roughly
+    nCells cells, where the experimental values follow the control values with a little noise
+    and a small fraction of cells are spiked to look like anomalies.
+
+    Arguments:
+        nCells (int):        The approximate number of cells per sheet.
+        nColumns (int):      The number of columns per sheet. Default is 100.
+        anomalyRate (float): The fraction of cells that are spiked. Default is 0.01.
+        seed (int):          The random seed, so every run sees the same sheets. Default is 42.
+
+    Returns:
+        control (DataFrame):      The synthetic control measurements.
+        experimental (DataFrame): The synthetic experimental measurements.
+    """
+    rng = numpy.random.default_rng(seed)
+    nColumns = min(nColumns, nCells)
+    nRows = max(1, nCells // nColumns)
+
+    control = rng.integers(50, 150, size=(nRows, nColumns))
+    noise = rng.normal(1.0, 0.05, size=control.shape)
+    spikes = rng.random(control.shape) < anomalyRate
+    noise[spikes] *= rng.choice([0.3, 3.0], size=spikes.sum())
+    experimental = numpy.rint(control * noise).astype(numpy.int64)
+
+    return pandas.DataFrame(control), pandas.DataFrame(experimental)
+
+
+def legacyThreshold(normalizedData, experimental, multiplier=1.0, nFolds=5):
+    """
+    The legacyThreshold() function is the original cell-by-cell threshold(), kept as the
+    reference that the vectorized version is checked against.
+    """
+    withinthreshold = []
+    data = pandas.DataFrame({"Experimental": experimental.values.flatten(), "Ratio": normalizedData.values.flatten()})
+    acceptableThreshold = dds.findThreshold(data, multiplier, nFolds, method="sklearn")
+    lowerBound = 1 - acceptableThreshold
+    upperBound = 1 + acceptableThreshold
+    for row in range(normalizedData.shape[0]):
+        for column in range(normalizedData.shape[1]):
+            value = normalizedData.iloc[row, column]
+            saveValue = experimental.iloc[row, column]
+            if value <= lowerBound or value >= upperBound:
+                originalLocation = f"{openpyxl.utils.get_column_letter(column + 1)}{row + 1}"
+                withinthreshold.append((saveValue, originalLocation))
+    return withinthreshold
+
+
+def benchmarkThreshold(sizes, legacyLimit=10**5):
+    """
+    The benchmarkThreshold() function times threshold() on synthetic sheets of each size and,
+    for sizes up to legacyLimit, also times the original loop and checks that both write
+    byte-identical output CSVs.
+
+    Arguments:
+        sizes (list):      The sheet sizes, in cells, to benchmark.
+        legacyLimit (int): The largest size the (slow) original loop is run on. Default is 10^5.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for nCells in sizes:
+            control, experimental = syntheticSheets(nCells)
+            normalizedData = experimental / control
+
+            start = time.perf_counter()
+            anomalies = dds.threshold(normalizedData, experimental)
+            elapsed = time.perf_counter() - start
+            dds.outputFile(anomalies, os.path.join(tmp, "new.csv"))
+            line = f"{nCells:>10} cells: threshold {elapsed:9.3f} s, {len(anomalies)} anomalies"
+            row = {"case": f"{nCells} cells", "seconds": elapsed}
+
+            if nCells <= legacyLimit:
+                start = time.perf_counter()
+                legacy = legacyThreshold(normalizedData, experimental)
+                legacyElapsed = time.perf_counter() - start
+                dds.outputFile(legacy, os.path.join(tmp, "legacy.csv"))
+                same = filecmp.cmp(os.path.join(tmp, "new.csv"), os.path.join(tmp, "legacy.csv"), shallow=False)
+                line += f" | loop {legacyElapsed:9.3f} s ({legacyElapsed / elapsed:.1f}x), CSV {'unchanged' if same else 'DIFFERS'}"
+                row.update({"legacySeconds": legacyElapsed, "sameOutput": same})
+            print(line)
+            results.append(row)
+    return results
+
+
+def benchmarkFindThreshold(sizes, foldCounts=(5, 10)):
+    """
+    The benchmarkFindThreshold() function times kFoldRmse() against the scikit-learn reference
+    on synthetic sheets and reports how far apart their RMSEs are.
+
+    Arguments:
+        sizes (list):      The sheet sizes, in cells, to benchmark.
+        foldCounts (list): The numbers of folds to check. Default is (5, 10).
+    """
+    results = []
+    for nCells in sizes:
+        control, experimental = syntheticSheets(nCells)
+        x = experimental.values.flatten()
+        y = (experimental / control).values.flatten()
+        for nFolds in foldCounts:
+            start = time.perf_counter()
+            fast = dds.kFoldRmse(x, y, nFolds)
+            fastElapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            reference = dds.sklearnKFoldRmse(x, y, nFolds)
+            referenceElapsed = time.perf_counter() - start
+
+            print(f"{nCells:>10} cells, {nFolds:>2} folds: closed form {fastElapsed * 1000:9.2f} ms, "
+                  f"sklearn {referenceElapsed * 1000:9.2f} ms ({referenceElapsed / fastElapsed:.0f}x), "
+                  f"relative RMSE difference {abs(fast - reference) / reference:.1e}")
+            results.append({"case": f"{nCells} cells, {nFolds} folds", "seconds": fastElapsed,
+                            "sklearnSeconds": referenceElapsed, "relativeDifference": abs(fast - reference) / reference})
+    return results
+
+
+def measure(function, *arguments):
+    """
+    The measure() function calls function twice: once timed, and once under tracemalloc to find
+    the peak memory it allocates, so the tracing overhead does not end up in the time.
+
+    Arguments:
+        function (callable): The function to measure.
+        arguments:           The arguments to call it with.
+
+    Returns:
+        result:          What the function returned.
+        seconds (float): The time the untraced call took.
+        peakBytes (int): The most memory allocated at once during the traced call.
+    """
+    start = time.perf_counter()
+    result = function(*arguments)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        function(*arguments)
+        _, peakBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peakBytes
+
+
+def benchmarkStages(sizes):
+    """
+    The benchmarkStages() function times each stage of the pipeline, normalize(), findThreshold(),
+    threshold() and outputFile(), on synthetic sheets saved as .npy files, and records the peak
+    memory each one allocates.
+
+    Arguments:
+        sizes (list): The sheet sizes, in cells, to benchmark.
+
+    Returns:
+        results (list): One dictionary per size and stage, with its time and peak memory.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        controlFile = os.path.join(tmp, "control.npy")
+        experimentalFile = os.path.join(tmp, "experimental.npy")
+        for nCells in sizes:
+            control, experimental = syntheticSheets(nCells)
+            numpy.save(controlFile, control.to_numpy())
+            numpy.save(experimentalFile, experimental.to_numpy())
+
+            (normalizedData, experimental), *normalizeCost = measure(dds.normalize, controlFile, experimentalFile)
+            data = pandas.DataFrame({"Experimental": experimental.values.flatten(), "Ratio": normalizedData.values.flatten()})
+            _, *findThresholdCost = measure(dds.findThreshold, data)
+            anomalies, *thresholdCost = measure(dds.threshold, normalizedData, experimental)
+            _, *outputFileCost = measure(dds.outputFile, anomalies, os.path.join(tmp, "anomalies.csv"))
+
+            # The binary outputs skip labelling, so flagging and writing are timed together.
+            acceptableThreshold = dds.findThreshold(data)
+            def flagAndWrite(filename):
+                dds.writeAnomalyArrays(*dds.findAnomalyArrays(normalizedData, experimental, acceptableThreshold), filename)
+
+            _, *npyCost = measure(flagAndWrite, os.path.join(tmp, "anomalies.npy"))
+            _, *parquetCost = measure(flagAndWrite, os.path.join(tmp, "anomalies.parquet"))
+
+            stages = {"normalize": normalizeCost, "findThreshold": findThresholdCost,
+                      "threshold": thresholdCost, "outputFile": outputFileCost,
+                      "flagAndSaveNpy": npyCost, "flagAndSaveParquet": parquetCost}
+            for stage, (seconds, peakBytes) in stages.items():
+                results.append({"case": f"{stage} {nCells} cells", "seconds": seconds, "peakMegabytes": peakBytes / 2**20})
+                print(f"{nCells:>10} cells: {stage:<18} {seconds * 1000:10.2f} ms, peak {peakBytes / 2**20:9.2f} MB")
+            outputSizes = {extension: os.path.getsize(os.path.join(tmp, "anomalies." + extension)) for extension in ("csv", "npy", "parquet")}
+            results.append({"case": f"output size {nCells} cells", **{extension + "Kilobytes": size / 2**10 for extension, size in outputSizes.items()}})
+            print(f"{nCells:>10} cells: output size " + ", ".join(f"{extension} {size / 2**10:.1f} kB" for extension, size in outputSizes.items()))
+    return results
+
+
+def benchmarkStartup(runs=5):
+    """
+    The benchmarkStartup() function measures how long a fresh interpreter takes to import the
+    script, as every spawned batch worker does, and checks it against STARTUP_TARGET_MS.
+
+    Arguments:
+        runs (int): The number of fresh interpreters to time; the fastest one counts. Default is 5.
+
+    Returns:
+        results (list): The import time, and whether scikit-learn was imported along with it.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = (f"import sys, time; sys.path.insert(0, {here!r}); start = time.perf_counter(); "
+            "import Daniel_Dejud_Data_Science; print(time.perf_counter() - start, 'sklearn' in sys.modules)")
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        sklearnLoaded = output[1] == "True"
+    milliseconds = min(times) * 1000
+    print(f"import: {milliseconds:9.1f} ms (target {STARTUP_TARGET_MS} ms, {'ok' if milliseconds <= STARTUP_TARGET_MS else 'SLOW'}), "
+          f"scikit-learn {'imported' if sklearnLoaded else 'not imported'}")
+    return [{"case": "import", "ms": milliseconds, "sklearnLoaded": sklearnLoaded}]
+
+
+def gitRevision():
+    """
+    The gitRevision() function returns the short hash of the checked out commit, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def saveResults(filename, results):
+    """
+    The saveResults() function writes the results to a JSON file, along with the commit and
+    machine they came from, so runs on different commits can be compared.
+
+    Arguments:
+        filename (str): The JSON file to write.
+        results (dict): The results of each benchmark, keyed by benchmark name.
+    """
+    with open(filename, "w") as f:
+        json.dump({"commit": gitRevision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
+
+
+def compareResults(filename, results):
+    """
+    The compareResults() function prints every measurement next to the same measurement in an
+    earlier results file.
+
+    Arguments:
+        filename (str): The JSON file written by saveResults() on an earlier run.
+        results (dict): The results of this run, keyed by benchmark name.
+    """
+    with open(filename) as f:
+        old = json.load(f)
+    print(f"compared with {filename} (commit {old.get('commit')}):")
+    for benchmark, rows in results.items():
+        oldRows = {row["case"]: row for row in old["results"].get(benchmark, [])}
+        for row in rows:
+            oldRow = oldRows.get(row["case"])
+            if oldRow is None:
+                continue
+            for metric, value in row.items():
+                if metric != "case" and isinstance(value, float) and oldRow.get(metric):
+                    print(f"  {benchmark:<14} {row['case']:<32} {metric:<18} {oldRow[metric]:12.4f} -> {value:12.4f} "
+                          f"({value / oldRow[metric]:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the anomaly detection pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6, 10**7])
+    parser.add_argument("--legacy-limit", type=int, default=10**5)
+    parser.add_argument("--json", metavar="FILE", help="save the results to a JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with an earlier JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    results["startup"] = benchmarkStartup()
+    results["stages"] = benchmarkStages(args.sizes)
+    results["threshold"] = benchmarkThreshold(args.sizes, args.legacy_limit)
+    results["findThreshold"] = benchmarkFindThreshold(args.sizes)
+
+    if args.json:
+        saveResults(args.json, results)
+    if args.compare:
+        compareResults(args.compare, results)
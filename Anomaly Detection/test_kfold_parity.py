@@ -0,0 +1,45 @@
+"""
+Checks that the closed-form kFoldRmse() gives the same average RMSE as the scikit-learn
+reference, sklearnKFoldRmse(), for even and uneven folds, one sample per fold and a constant
+feature, and that both thresholds agree on the example sheets.
+"""
+import os
+
+import numpy
+import pandas
+import pytest
+
+import Daniel_Dejud_Data_Science as dds
+
+
+def sampleData(nSamples, seed=0):
+    random = numpy.random.RandomState(seed)
+    x = random.uniform(1, 100, nSamples)
+    y = 1 + 0.002 * x + random.normal(0, 0.05, nSamples)
+    return x, y
+
+
+@pytest.mark.parametrize("nSamples, nFolds", [
+    (1000, 5),   # Folds of equal size.
+    (1003, 5),   # Uneven folds: the first nSamples % nFolds folds get one more sample.
+    (103, 10),
+    (12, 12),    # One sample per fold.
+])
+def testKFoldRmseMatchesSklearn(nSamples, nFolds):
+    x, y = sampleData(nSamples)
+    assert numpy.isclose(dds.kFoldRmse(x, y, nFolds), dds.sklearnKFoldRmse(x, y, nFolds), rtol=1e-9)
+
+
+def testKFoldRmseMatchesSklearnForConstantFeature():
+    _, y = sampleData(57)
+    x = numpy.full(57, 3.5)
+    assert numpy.isclose(dds.kFoldRmse(x, y, 5), dds.sklearnKFoldRmse(x, y, 5), rtol=1e-9)
+
+
+def testThresholdMethodsMatchOnExampleSheets():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    normalizedData, experimental = dds.normalize(os.path.join(folder, "Exam_control measurements1.xlsx"),
+                                                 os.path.join(folder, "Exam_experimental_measurements1.xlsx"))
+    data = pandas.DataFrame({"Experimental": experimental.to_numpy().ravel(), "Ratio": normalizedData.to_numpy().ravel()})
+    for nFolds in (5, 10):
+        assert numpy.isclose(dds.findThreshold(data, nFolds=nFolds), dds.findThreshold(data, nFolds=nFolds, method="sklearn"), rtol=1e-9)